@@ -56,6 +56,50 @@ def main():
   )
   _add_close_cow_args(parser_a)
 
+  # checkpoint arguments
+  parser_a = subparsers.add_parser(
+    'checkpoint',
+    help='start tracking the blocks changed from now on'
+  )
+  _add_backend_args(parser_a)
+  _add_name_args(parser_a)
+  parser_a.add_argument(
+    'checkpoint',
+    metavar='<checkpoint>',
+    type=_checkpoint_name,
+    help="name of the checkpoint - an existing checkpoint is reset"
+  )
+  _add_auth_args(parser_a)
+  parser_a.add_argument(
+    '--delete',
+    action='store_true',
+    help="delete the checkpoint instead"
+  )
+
+  # clone and snapshot arguments
+  for command, help in (
+      ('clone', 'copy a volume into a new volume on the cloud side'),
+      ('snapshot', 'copy a volume into a new read only volume on the'
+                   ' cloud side')):
+    parser_a = subparsers.add_parser(command, help=help)
+    _add_backend_args(parser_a)
+    _add_name_args(parser_a)
+    parser_a.add_argument(
+      'new_volume',
+      metavar='<new-volume>',
+      type=unicode,
+      help="name of the new volume"
+    )
+    _add_auth_args(parser_a)
+    parser_a.add_argument(
+      '-t', '--threads',
+      type=int,
+      metavar='<count>',
+      default=cloudnbd._default_copy_thread_count,
+      help="number of copy threads (default: %d)" \
+            % cloudnbd._default_copy_thread_count
+    )
+
   # delete arguments
   parser_a = subparsers.add_parser(
     'delete',
@@ -77,6 +121,36 @@ def main():
     help="number of delete threads (default: %d)" \
           % cloudnbd._default_delete_thread_count
   )
+  _add_connections_args(parser_a)
+
+  # export arguments
+  parser_a = subparsers.add_parser(
+    'export',
+    help='write out the blocks of a volume changed since a checkpoint'
+  )
+  _add_backend_args(parser_a)
+  _add_name_args(parser_a)
+  _add_auth_args(parser_a)
+  parser_a.add_argument(
+    '-s', '--since',
+    metavar='<checkpoint>',
+    type=_checkpoint_name,
+    help="only export blocks changed since the checkpoint"
+         " (default: export all blocks)"
+  )
+  parser_a.add_argument(
+    '-o', '--output',
+    metavar='<file>',
+    help="file to write to (default: standard output)"
+  )
+  parser_a.add_argument(
+    '-t', '--threads',
+    type=int,
+    metavar='<count>',
+    default=cloudnbd._default_write_thread_count,
+    help="number of read threads (default: %d)" \
+          % cloudnbd._default_write_thread_count
+  )
 
   # info arguments
   parser_a = subparsers.add_parser(
@@ -96,7 +170,28 @@ def main():
   _add_name_args(parser_a)
   _add_size_args(parser_a, as_arg=True)
   _add_blocksize_args(parser_a)
+  _add_codec_args(parser_a)
   _add_auth_args(parser_a)
+  parser_a.add_argument(
+    '-d', '--dedup',
+    action='store_true',
+    help="store identical blocks only once"
+  )
+  parser_a.add_argument(
+    '-l', '--layout',
+    choices=['object', 'segment'],
+    default='object',
+    help="store each block as an object, or pack blocks into large"
+         " segment objects to save on requests (default: object)"
+  )
+  parser_a.add_argument(
+    '--segment-size',
+    metavar="<size>",
+    type=_storage_size,
+    default=cloudnbd._default_segment_size,
+    help="size of segments in the segment layout (default: %d)"
+         % cloudnbd._default_segment_size
+  )
   
   # list arguments
   parser_a = subparsers.add_parser(
@@ -127,6 +222,16 @@ def main():
     help="number of write threads (default: %d)" \
           % cloudnbd._default_write_thread_count
   )
+  _add_connections_args(parser_a)
+  parser_a.add_argument(
+    '-j', '--procs',
+    type=int,
+    metavar='<count>',
+    default=cloudnbd._default_codec_proc_count,
+    help="number of processes to compress/encrypt blocks in - 0 does"
+         " it in the write threads (default: %d)" \
+          % cloudnbd._default_codec_proc_count
+  )
   parser_a.add_argument(
     '-r', '--read-ahead',
     type=int,
@@ -135,6 +240,14 @@ def main():
     help="number of blocks to read ahead (default: %d)" \
           % cloudnbd._default_read_ahead_count
   )
+  _add_limit_args(parser_a)
+  parser_a.add_argument(
+    '--hedge',
+    type=_percentile,
+    metavar='<percentile>',
+    help="send a read again on another connection once it takes longer"
+         " than this percentile of the recent reads - e.g. 95"
+  )
   parser_a.add_argument(
     '-e', '--max-cache',
     type=_storage_size,
@@ -150,6 +263,30 @@ def main():
     help="run the server in the foreground"
   )
 
+  # rebs arguments
+  parser_a = subparsers.add_parser(
+    'rebs',
+    help='copy a volume into a new volume with a different block size'
+  )
+  _add_backend_args(parser_a)
+  _add_name_args(parser_a)
+  parser_a.add_argument(
+    'new_volume',
+    metavar='<new-volume>',
+    type=unicode,
+    help="name of the new volume"
+  )
+  _add_blocksize_args(parser_a, required=True)
+  _add_auth_args(parser_a)
+  parser_a.add_argument(
+    '-t', '--threads',
+    type=int,
+    metavar='<count>',
+    default=cloudnbd._default_write_thread_count,
+    help="number of read and write threads each (default: %d)" \
+          % cloudnbd._default_write_thread_count
+  )
+
   # resize arguments
   parser_a = subparsers.add_parser(
     'resize',
@@ -162,8 +299,17 @@ def main():
   parser_a.add_argument(
     '-u', '--cleanup',
     action='store_true',
-    help="perform block cleanup for the unused block"
+    help="perform cleanup of the unused blocks and content"
   )
+  parser_a.add_argument(
+    '-t', '--threads',
+    type=int,
+    metavar='<count>',
+    default=cloudnbd._default_delete_thread_count,
+    help="number of cleanup threads (default: %d)" \
+          % cloudnbd._default_delete_thread_count
+  )
+  _add_connections_args(parser_a)
 
   # stat arguments
   parser_a = subparsers.add_parser(
@@ -173,6 +319,15 @@ def main():
   _add_backend_args(parser_a)
   _add_name_args(parser_a)
 
+  # limit arguments
+  parser_a = subparsers.add_parser(
+    'limit',
+    help='change the bandwidth and request rate limits of an open volume'
+  )
+  _add_backend_args(parser_a)
+  _add_name_args(parser_a)
+  _add_limit_args(parser_a)
+
   args = parser.parse_args()
 
   exec ('import cloudnbd.cmd.%scmd' % args.command) \
@@ -194,6 +349,51 @@ def _storage_size(value):
     msg = "%s must be in the form: <int><K|M|G|T|P>"
     raise argparse.ArgumentTypeError(msg)
 
+def _block_size(value):
+  """Parse a block size which must be a multiple of 512 bytes. Unlike
+  other sizes, the K and M multipliers are binary.
+  """
+  import re
+  m = re.match(ur'^(\d+)([km]?)$', value.strip().lower())
+  size = int(m.group(1)) * {'': 1, 'k': 2 ** 10, 'm': 2 ** 20}[
+    m.group(2)] if m else 0
+  if size <= 0 or size % 512:
+    raise argparse.ArgumentTypeError(
+      "block size must be a multiple of 512 bytes in the form"
+      " <int>[K|M] - K being 1024 bytes")
+  return size
+
+def _request_rate(value):
+  """Parse a request rate which must not be negative."""
+  try:
+    rate = int(value)
+  except ValueError:
+    rate = -1
+  if rate < 0:
+    raise argparse.ArgumentTypeError(
+      "request rate must be a whole number of 0 or more")
+  return rate
+
+def _percentile(value):
+  """Parse a percentile which must be between 0 and 100."""
+  try:
+    percentile = float(value)
+  except ValueError:
+    percentile = -1
+  if not 0 < percentile < 100:
+    raise argparse.ArgumentTypeError(
+      "percentile must be a number between 0 and 100")
+  return percentile
+
+def _checkpoint_name(value):
+  """Parse a checkpoint name."""
+  import re
+  if not re.match(r'^[A-Za-z0-9_.-]+$', value):
+    raise argparse.ArgumentTypeError(
+      "checkpoint names may only contain letters, digits, '_', '.'"
+      " and '-'")
+  return unicode(value)
+
 def _add_name_args(parser):
   """Add volume bucket and name arguments to the parser."""
   parser.add_argument(
@@ -220,6 +420,32 @@ def _add_close_cow_args(parser):
          ", or use 'discard' to drop all the changes"
   )
 
+def _add_connections_args(parser):
+  parser.add_argument(
+    '--connections',
+    type=int,
+    metavar='<count>',
+    default=cloudnbd._default_connection_count,
+    help="maximum number of connections to the cloud the threads share"
+         " (default: %d)" % cloudnbd._default_connection_count
+  )
+
+def _add_limit_args(parser):
+  for direction in ('upload', 'download'):
+    parser.add_argument(
+      '--%s-limit' % direction,
+      type=_storage_size,
+      metavar='<size>',
+      help="maximum %ss in bytes per second, 0 for no limit -"
+           " e.g. 1M which is 1 megabyte" % direction
+    )
+    parser.add_argument(
+      '--%s-reqs' % direction,
+      type=_request_rate,
+      metavar='<count>',
+      help="maximum %s requests per second, 0 for no limit" % direction
+    )
+
 def _add_size_args(parser, as_arg = False):
   """Add size argument to the parser.
 
@@ -235,14 +461,35 @@ def _add_size_args(parser, as_arg = False):
          " e.g. 100T which is 100 terabytes"
   )
 
-def _add_blocksize_args(parser):
-  """Add block size argument to the parser."""
+def _add_blocksize_args(parser, required = False):
+  """Add block size argument to the parser.
+
+  Parameters:
+    required - if True, makes the block size a required option with no
+               default value
+  """
   parser.add_argument(
     '-b', '--block-size',
     metavar="<size>",
-    type=_storage_size,
-    help="block size of blocks as stored on the cloud - e.g. 100T"
-         " which is 100 terabytes (default: %d)" % cloudnbd._default_bs
+    type=_block_size,
+    required=required,
+    default=None if required else cloudnbd._default_bs,
+    help="block size of blocks as stored on the cloud - e.g. 1M"
+         " which is 1 mebibyte (1048576 bytes)"
+         + ("" if required else " (default: %d)" % cloudnbd._default_bs)
+  )
+
+def _add_codec_args(parser):
+  """Add compression codec argument to the parser."""
+  parser.add_argument(
+    '-z', '--codec',
+    metavar="<codec>",
+    default=cloudnbd._default_codec,
+    type=unicode,
+    help="compression codec for blocks in the form <name>[:<level>]"
+         " - one of %s - e.g. zlib:1 (default: %s)"
+         % (', '.join(sorted(cloudnbd.codec.codecs)),
+            cloudnbd._default_codec)
   )
 
 def _add_server_args(parser):
@@ -270,7 +517,9 @@ def _add_auth_args(parser):
     '-a', '--access-key',
     metavar="<access-key>",
     type=unicode,
-    help="access key"
+    help="access key - for the file backend, the directory holding"
+         " the buckets, and for the stripe backend, the backend of the"
+         " buckets and its access key as <backend>:<access-key>"
   )
   parser.add_argument(
     '-y', '--passphrase',
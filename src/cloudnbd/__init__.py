@@ -11,6 +11,7 @@ import time
 import threading
 import re
 import glob
+import collections
 
 _ver_major = 0
 _ver_minor = 1
@@ -24,6 +25,10 @@ _prog_name = 'cloudbd'
 _print_ver = '%s %s' % (_prog_name, __version__)
 
 _default_bs = 2 ** 16
+_default_codec = 'zlib'
+_compress_probe_size = 2 ** 12
+_compress_probe_samples = 4
+_compress_probe_ratio = 0.95
 _default_bind = ''
 _default_port = 7323
 _default_total_cache_size = 2 ** 24
@@ -31,7 +36,27 @@ _write_to_total_cache_ratio = 0.5
 _write_queue_to_flush_ratio = 0.7
 _default_write_thread_count = 10
 _default_delete_thread_count = 30
+_default_copy_thread_count = 30
+_delete_batch_size = 1000
+_default_connection_count = 16
+_retry_base_delay = 0.1
+_retry_max_delay = 60
+_retry_max_attempts = 20
+_write_retry_delay = 5
+_hedge_window = 1000
+_hedge_min_samples = 20
+_hedge_max_ratio = 0.05
+_throttle_burst = 1
 _default_read_ahead_count = 3
+_dedup_index_size = 2 ** 18
+_absent_index_size = 2 ** 20
+_fingerprint_index_size = 2 ** 20
+_default_codec_proc_count = 0
+_default_segment_size = 2 ** 25
+_segmap_save_interval = 16
+_segment_flush_interval = 5
+_segment_compact_interval = 60
+_segment_compact_ratio = 0.5
 _stat_path = '/tmp/' + _prog_name + ':%s:%s:%s:%s'
 _stat_pat = re.compile(
   r'/' + _prog_name + r':([^:]+):([^:]+):([^:]+):(.+)$'
@@ -64,6 +89,9 @@ def get_stat_path(backend, bucket, volume):
 def get_pid_path(backend, bucket, volume):
   return _stat_path % (backend, bucket, volume, 'pid')
 
+def get_ctl_path(backend, bucket, volume):
+  return _stat_path % (backend, bucket, volume, 'ctl')
+
 def get_stat_paths():
   file_list = glob.glob(_stat_glob)
   file_list = map(get_path_comps, file_list)
@@ -130,6 +158,54 @@ class SyncQueue(object):
       if k in self._queue:
         self._queue.remove(k)
 
+class LRUDict(object):
+  """Thread safe mapping which forgets its least recently used items
+  once it grows beyond its capacity.
+  """
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self._items = collections.OrderedDict()
+    self._lock = threading.RLock()
+
+  def __contains__(self, k):
+    with self._lock:
+      if k in self._items:
+        self._items[k] = self._items.pop(k)
+        return True
+      return False
+
+  def __len__(self):
+    with self._lock:
+      return len(self._items)
+
+  def __setitem__(self, k, v):
+    with self._lock:
+      self._items.pop(k, None)
+      self._items[k] = v
+      while len(self._items) > self.capacity:
+        self._items.popitem(last=False)
+
+  def get(self, k, default = None):
+    with self._lock:
+      if k in self._items:
+        v = self._items[k] = self._items.pop(k)
+        return v
+      return default
+
+  def pop(self, k, default = None):
+    with self._lock:
+      return self._items.pop(k, default)
+
+class LRUSet(LRUDict):
+  """Thread safe set which forgets its least recently used items once
+  it grows beyond its capacity.
+  """
+  def add(self, k):
+    self[k] = True
+
+  def discard(self, k):
+    self.pop(k)
+
 def _def_backer(key):
   return None
 
@@ -176,7 +252,10 @@ class Cache(dict):
     """Trim the unqueued items down to the total size."""
     with self._lock:
       if len(self) > self.total_size:
-        unqueued = filter(lambda a: a not in self._queue, self.keys())
+        unqueued = filter(
+          lambda a: a not in self._queue and a not in self._pinned,
+          self.keys()
+        )
         unqueued.sort(cmp=lambda a, b: cmp(self._ts[a], self._ts[b]))
         unqueued = unqueued[0:len(self) - self.total_size]
         for k in unqueued:
@@ -187,7 +266,7 @@ class Cache(dict):
   def __setitem__(self, key, value):
     with self._lock:
       while (key not in self._queue
-             and len(self._queue) == self.queue_size):
+             and len(self._queue) >= self.queue_size):
         self._set_wait.wait()
       super(Cache, self).__setitem__(key, value)
       self._ts[key] = time.time()
@@ -196,9 +275,24 @@ class Cache(dict):
       self._queue.append(key)
       self._stats['queue_size'] = len(self._queue)
       self._trim()
-      if len(self._queue) == self.queue_size:
+      if len(self._queue) >= self.queue_size:
         self._dequeue_wait.notify_all()
 
+  def set_clean(self, key, value, pred = None):
+    """Store the value without queuing it, provided there is no pending
+    write for the key and pred (if given) holds while the cache is
+    locked. Returns whether the value was stored.
+    """
+    with self._lock:
+      if key in self._queue or key in self._pinned:
+        return False
+      if pred is not None and not pred():
+        return False
+      super(Cache, self).__setitem__(key, value)
+      self._ts[key] = time.time()
+      self._trim()
+      return True
+
   def _pop_next_unpinned_key(self):
     for i, key in zip(xrange(len(self._queue)), self._queue):
       if key not in self._pinned:
@@ -239,6 +333,17 @@ class Cache(dict):
         self._pinned.remove(key)
         self._dequeue_wait.notify_all()
 
+  def requeue(self, key):
+    """Queue a dequeued key again after its write failed, unless it was
+    set again in the meantime, and unpin it.
+    """
+    with self._lock:
+      if key not in self._queue:
+        self._queue.append(key)
+        self._stats['queue_size'] = len(self._queue)
+      self._pinned.discard(key)
+      self._dequeue_wait.notify_all()
+
   def set_wait_on_empty(self, v):
     with self._lock:
       self._wait_on_empty = v
@@ -251,6 +356,10 @@ class Cache(dict):
 from cloudnbd import cmd
 from cloudnbd import auth
 from cloudnbd import cloud
+from cloudnbd import codec
+from cloudnbd import bitmap
+from cloudnbd import overlay
 from cloudnbd import blocktree
+from cloudnbd import pipeline
 from cloudnbd import nbd
 from cloudnbd import daemon
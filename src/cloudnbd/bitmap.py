@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# bitmap.py - Compact sets of block numbers
+# Copyright (C) 2011  Mansour <mansour@oxplot.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import cloudnbd
+import threading
+import zlib
+
+class BitmapError(Exception):
+  pass
+
+def checkpoint_path(name):
+  """Return the path of the bitmap of blocks changed since the
+  checkpoint with the given name.
+  """
+  return 'checkpoints/%s' % name
+
+class Bitmap(object):
+  """Thread safe set of block numbers stored as one bit per block. The
+  bitmap grows as higher blocks are added.
+  """
+
+  def __init__(self, data = b''):
+    self._bits = bytearray(data)
+    self._lock = threading.Lock()
+    self.dirty = False
+
+  def __contains__(self, n):
+    i = n >> 3
+    return i < len(self._bits) and bool(self._bits[i] & (1 << (n & 7)))
+
+  def add(self, n):
+    i = n >> 3
+    with self._lock:
+      if i >= len(self._bits):
+        self._bits.extend(b'\0' * (i + 1 - len(self._bits)))
+      if not self._bits[i] & (1 << (n & 7)):
+        self._bits[i] |= 1 << (n & 7)
+        self.dirty = True
+
+  def discard(self, n):
+    i = n >> 3
+    with self._lock:
+      if i < len(self._bits) and self._bits[i] & (1 << (n & 7)):
+        self._bits[i] &= ~(1 << (n & 7)) & 0xff
+        self.dirty = True
+
+  def __iter__(self):
+    """Iterate over the block numbers in the bitmap in order."""
+    with self._lock:
+      bits = bytes(self._bits)
+    for i, byte in enumerate(bytearray(bits)):
+      if byte:
+        for b in xrange(8):
+          if byte & (1 << b):
+            yield (i << 3) | b
+
+  def __len__(self):
+    with self._lock:
+      return sum(bin(b).count('1') for b in self._bits)
+
+  def serialize(self):
+    with self._lock:
+      return zlib.compress(bytes(self._bits), 1)
+
+  @staticmethod
+  def deserialize(data):
+    try:
+      return Bitmap(zlib.decompress(data))
+    except zlib.error:
+      raise BitmapError('corrupted bitmap')
@@ -23,11 +23,11 @@ from __future__ import division
 import cloudnbd
 import os
 import struct
-import zlib
 import hashlib
 import time
 import threading
 import re
+import hmac
 from Crypto.Cipher import AES
 
 class BTError(Exception):
@@ -37,20 +37,108 @@ class BTInvalidKey(BTError):
 class BTChecksumError(BTError):
   pass
 
+# objects whose header flags have this bit set are sealed with AES-GCM
+# which both encrypts and authenticates the data - all other objects are
+# in the original AES-CBC format with the checksum in their metadata
+_aead_flag = 0x80
+# objects with this bit set hold the content hash of a block stored
+# under data/ instead of the block itself
+_ref_flag = 0x40
+_codec_mask = 0x3f
+_aead_supported = hasattr(AES, 'MODE_GCM')
+_nonce_len = 12
+_tag_len = 16
+_header_len = struct.calcsize(b'!BQ')
+
+def _output_supported():
+  try:
+    buf = bytearray(16)
+    AES.new(b'\0' * 16, AES.MODE_ECB).encrypt(buf, output=buf)
+    return True
+  except TypeError:
+    return False
+
+_crypt_output = _output_supported()
+
+_block_pat = re.compile(r'^(.*?blocks/)(\d+)$')
+
+def _crypt_into(crypt, data, out):
+  """Run the cipher function over data, storing the result in the
+  writable buffer out without an intermediate copy when the crypto
+  library allows it.
+  """
+  if _crypt_output:
+    crypt(data, output=out)
+  else:
+    out[:] = crypt(bytes(data))
+
+# the allocation bitmap object starts with one of these - a volume in
+# use is marked unclean as the bitmap is only saved on close
+_alloc_clean = b'\x01'
+_alloc_unclean = b'\x00'
+
+# paths at which listings of the objects of a volume are split into
+# shards listed concurrently - numbered and content addressed objects
+# are split by their leading digit
+_list_shard_bounds = \
+  ['blocks/%d' % d for d in xrange(1, 10)] + \
+  ['data/%x' % d for d in xrange(1, 16)] + \
+  ['segments/%d' % d for d in xrange(1, 10)] + \
+  ['layers/']
+
+def _block_num(path):
+  """Return the number of the volume block at path or None."""
+  m = _block_pat.match(path)
+  if m and m.group(1) == 'blocks/':
+    return int(m.group(2))
+  return None
+
+def _fingerprint(data):
+  return hashlib.sha1(data).digest() if data is not None else b''
+
+def _write(blocktree, cloud, path, data):
+  # the fingerprint must be updated before unpinning so a write checked
+  # against it never sees a stale one
+  if data is None:
+    # a block already known not to exist needs no delete
+    if not blocktree._is_absent(path):
+      cloud.delete(path)
+      with blocktree._stats_lock:
+        blocktree._stats['delete_count'] += 1
+    blocktree._absent.add(path)
+    blocktree._alloc_discard(path)
+    blocktree._fingerprints[path] = _fingerprint(None)
+    return
+  plain_data_len = len(data)
+  fingerprint = _fingerprint(data)
+  blocktree._alloc_add(path)
+  wire_data_len = blocktree._upload(cloud, path, data)
+  blocktree._absent.discard(path)
+  blocktree._fingerprints[path] = fingerprint
+  with blocktree._stats_lock:
+    blocktree._stats['sent_count'] += 1
+    blocktree._stats['data_sent'] += plain_data_len
+    blocktree._stats['wire_sent'] += wire_data_len
+
 def _writer_factory(blocktree):
   cloud = blocktree.cloud.clone()
   def writer():
     try:
       while True:
         path, data = blocktree._cache.dequeue()
-        checksum = blocktree._build_checksum(path, data)
-        plain_data_len = len(data)
-        data = blocktree._encrypt_data(path, data)
-        cloud.set(path, data, metadata={'checksum': checksum})
-        with blocktree._stats_lock:
-          blocktree._stats['sent_count'] += 1
-          blocktree._stats['data_sent'] += plain_data_len
-          blocktree._stats['wire_sent'] += len(data)
+        try:
+          _write(blocktree, cloud, path, data)
+        except Exception as e:
+          # the data stays in the cache and the write is tried again
+          # later, so the writer lives on and close() only returns once
+          # everything has reached the cloud
+          with blocktree._stats_lock:
+            blocktree._stats['write_errors'] += 1
+          cloudnbd.cmd.warning('writing %s failed, retrying later: %s'
+                               % (path, e))
+          time.sleep(cloudnbd._write_retry_delay)
+          blocktree._cache.requeue(path)
+          continue
         blocktree._cache.unpin(path)
         del data
     except cloudnbd.QueueEmptyError:
@@ -63,7 +151,13 @@ def _reader_factory(blocktree):
     try:
       while True:
         k = blocktree._read_queue.pop()
-        value = _indep_get(blocktree, cloud, k)
+        try:
+          value = _indep_get(blocktree, cloud, k)
+        except Exception:
+          # reading ahead is best effort, the block is read again when
+          # it is actually asked for
+          blocktree._read_queue.remove(k)
+          continue
         blocktree._cache.set_super_item(k, value)
         blocktree._read_queue.remove(k)
     except cloudnbd.QueueEmptyError:
@@ -75,36 +169,69 @@ def _indep_get(blocktree, cloud, k):
   if obj:
     data = obj.get_content()
     wire_data_len = len(data)
-    data = blocktree._decrypt_data(k, data)
+    is_ref = data and ord(data[0]) & _ref_flag
+    data = blocktree.decode(k, data, obj.metadata)
+    if is_ref:
+      content_path = 'data/%s' % data
+      obj = cloud.get(content_path)
+      if not obj:
+        raise BTError("content of object:%s is missing" % k)
+      data = obj.get_content()
+      wire_data_len += len(data)
+      data = blocktree.decode(content_path, data, obj.metadata)
+      blocktree._known_content.add(content_path)
     with blocktree._stats_lock:
       blocktree._stats['recv_count'] += 1
       blocktree._stats['data_recv'] += len(data)
       blocktree._stats['wire_recv'] += wire_data_len
-    cloud_checksum = obj.metadata['checksum']
-    calc_checksum = blocktree._build_checksum(k, data)
-    if cloud_checksum != calc_checksum:
-      raise BTChecksumError(
-       "remote and calculated checksums for object:%s don't match" % k
-      )
     return data
 
 class BlockTree(object):
   """Interface between cloud and the high level logic."""
   def __init__(self, pass_key = None, crypt_key = None, cloud = None,
-               threads = 1, read_ahead = 0):
+               threads = 1, read_ahead = 0, codec = None,
+               dedup = False):
     self._stats_lock = threading.RLock()
     self._stats = {'recv_count': 0, 'data_recv': 0, 'wire_recv': 0,
-                   'sent_count': 0, 'data_sent': 0, 'wire_sent': 0}
+                   'sent_count': 0, 'data_sent': 0, 'wire_sent': 0,
+                   'compressed': 0, 'compress_skipped': 0,
+                   'compress_wasted': 0, 'dedup_hits': 0,
+                   'delete_count': 0, 'absent_hits': 0,
+                   'unchanged_count': 0, 'write_errors': 0}
     self.pass_key = pass_key
     self.crypt_key = crypt_key
     self.cloud = cloud
+    self.codec = codec if codec else \
+      cloudnbd.codec.get_codec(cloudnbd._default_codec)
     self._cache = cloudnbd.Cache(backercb=self._cache_read_cb)
+    # content addressed storage of blocks
+    self.dedup = dedup
+    self._known_content = cloudnbd.LRUSet(cloudnbd._dedup_index_size)
+    # blocks known not to exist on the cloud
+    self._absent = cloudnbd.LRUSet(cloudnbd._absent_index_size)
+    # fingerprints of the content of blocks as last seen on the cloud
+    self._fingerprints = cloudnbd.LRUDict(
+      cloudnbd._fingerprint_index_size)
     # initialize the writer threads
     self._writers_active = False
     self.threads = threads
     # initialize the readahead threads
     self._readers_active = False
     self._read_ahead = read_ahead
+    # optional encode/decode worker processes
+    self._codec_pool = None
+    # bitmap of the blocks which exist on the cloud, if loaded
+    self.alloc = None
+    self._alloc_read_only = False
+
+  def start_codec_procs(self, procs, block_size = cloudnbd._default_bs):
+    """Move encoding/decoding of objects into the given number of
+    worker processes. Must be called before any threads are started as
+    the workers are forked from the current process.
+    """
+    if procs > 0:
+      self._codec_pool = cloudnbd.pipeline.CodecPool(
+        self, procs, block_size)
 
   def start_writers(self):
     self._writers = []
@@ -131,9 +258,80 @@ class BlockTree(object):
       comb_stats.update(self._cache.get_stats())
       return comb_stats
 
+  def load_bitmap(self, path):
+    """Load the bitmap stored at path, returning None if there is no
+    such bitmap or it was not saved cleanly.
+    """
+    data = self.fetch(path)
+    if data and data[:1] == _alloc_clean:
+      return cloudnbd.bitmap.Bitmap.deserialize(data[1:])
+    return None
+
+  def save_bitmap(self, path, bitmap):
+    """Save the bitmap at path, marking it clean. With bitmap None,
+    marks the bitmap at path unclean instead.
+    """
+    if bitmap is None:
+      self.set(path, _alloc_unclean, direct=True)
+    else:
+      self.set(path, _alloc_clean + bitmap.serialize(), direct=True)
+      bitmap.dirty = False
+
+  def open_alloc(self, rebuild = False, read_only = False):
+    """Load the allocation bitmap of the volume so reads of blocks
+    never written are served without asking the cloud. The bitmap is
+    rebuilt by listing the blocks if it is missing or was not saved
+    cleanly, and unless read_only, is marked unclean until close().
+    Returns True if the bitmap was rebuilt.
+    """
+    alloc = None if rebuild else self.load_bitmap('alloc')
+    rebuilt = alloc is None
+    if rebuilt:
+      alloc = cloudnbd.bitmap.Bitmap()
+      for k in self.cloud.list_sharded('blocks/', _list_shard_bounds):
+        alloc.add(int(k.name.split('/')[-1]))
+    if not read_only:
+      self.save_bitmap('alloc', None)
+    self._alloc_read_only = read_only
+    self.alloc = alloc
+    return rebuilt
+
+  def save_alloc(self):
+    """Save the allocation bitmap marking it clean. Must only be
+    called once all writes have reached the cloud.
+    """
+    if self.alloc is not None and not self._alloc_read_only:
+      self.save_bitmap('alloc', self.alloc)
+
+  def _alloc_add(self, path):
+    if self.alloc is not None:
+      n = _block_num(path)
+      if n is not None:
+        self.alloc.add(n)
+
+  def _alloc_discard(self, path):
+    if self.alloc is not None:
+      n = _block_num(path)
+      if n is not None:
+        self.alloc.discard(n)
+
+  def _is_absent(self, path):
+    """Return True if the object at path is known not to exist on the
+    cloud.
+    """
+    if self.alloc is not None:
+      n = _block_num(path)
+      if n is not None and n not in self.alloc:
+        return True
+    return path in self._absent
+
   def _cache_read_cb(self, k):
+    if self._is_absent(k):
+      with self._stats_lock:
+        self._stats['absent_hits'] += 1
+      return None
     if self._readers_active:
-      m = re.match(r'^(.*?blocks/)(\d+)$', k)
+      m = _block_pat.match(k)
       if m:
         s = int(m.group(2)) + 1
         e = s + self._read_ahead + 1
@@ -141,7 +339,12 @@ class BlockTree(object):
           ra_k = '%s%d' % (m.group(1), b)
           if ra_k not in self._cache:
             self._read_queue.push(ra_k)
-    return _indep_get(self, self.cloud, k)
+    value = _indep_get(self, self.cloud, k)
+    if _block_pat.match(k):
+      if value is None:
+        self._absent.add(k)
+      self._fingerprints[k] = _fingerprint(value)
+    return value
 
   def set_cache_limits(self, total = None, write = None, flush = None):
     if total is not None: self._cache.total_size = total
@@ -149,14 +352,120 @@ class BlockTree(object):
     if flush is not None: self._cache.flush_size = flush
 
   def set(self, path, data, direct = False):
-    """Upload/queue an object on/to be uploaded to cloud."""
+    """Upload/queue an object on/to be uploaded to cloud. Setting an
+    object to None deletes it.
+    """
     if direct:
-      checksum = self._build_checksum(path, data)
-      cryptdata = self._encrypt_data(path, data)
-      self.cloud.set(path, cryptdata, metadata={'checksum': checksum})
+      if data is None:
+        self.cloud.delete(path)
+        self._alloc_discard(path)
+      else:
+        self._alloc_add(path)
+        self._upload(self.cloud, path, data)
     else:
+      # drop writes which would not change what is on the cloud
+      if path in self._fingerprints:
+        fingerprint = _fingerprint(data)
+        if self._cache.set_clean(path, data,
+            lambda: self._fingerprints.get(path) == fingerprint):
+          with self._stats_lock:
+            self._stats['unchanged_count'] += 1
+          return
       self._cache[path] = data
 
+  def _upload(self, cloud, path, data):
+    """Encode and upload the data for the given path, returning the
+    number of bytes sent over the wire.
+    """
+    if not (self.dedup and data and _block_pat.match(path)):
+      data, metadata = self.encode(path, data)
+      cloud.set(path, data, metadata=metadata)
+      return len(data)
+    # store the data under its keyed hash and only a reference to it
+    # under path - identical blocks are uploaded only once
+    digest = hmac.new(self.crypt_key, data, hashlib.sha256).hexdigest()
+    content_path = 'data/%s' % digest
+    sent = 0
+    if self._is_content_known(cloud, content_path):
+      with self._stats_lock:
+        self._stats['dedup_hits'] += 1
+    else:
+      data, metadata = self.encode(content_path, data)
+      cloud.set(content_path, data, metadata=metadata)
+      self._known_content.add(content_path)
+      sent += len(data)
+    data, metadata = self._encode_ref(path, digest.encode('ascii'))
+    cloud.set(path, data, metadata=metadata)
+    return sent + len(data)
+
+  def _is_content_known(self, cloud, content_path):
+    if content_path in self._known_content:
+      return True
+    if cloud.exists(content_path):
+      self._known_content.add(content_path)
+      return True
+    return False
+
+  def _encode_ref(self, path, digest):
+    if _aead_supported:
+      return self._seal_data(path, digest, _ref_flag), {}
+    checksum = self._build_checksum(path, digest)
+    data = self._encrypt_data(path, digest, _ref_flag)
+    return data, {'checksum': checksum}
+
+  def encode(self, path, data):
+    """Turn plain data into the wire payload and metadata to be
+    stored on the cloud.
+    """
+    if self._codec_pool:
+      data, metadata, outcome = self._codec_pool.encode(path, data)
+    else:
+      data, metadata, outcome = self._encode(path, data)
+    if outcome:
+      with self._stats_lock:
+        self._stats[outcome] += 1
+    return data, metadata
+
+  def decode(self, path, data, metadata):
+    """Turn the wire payload and metadata back into plain data."""
+    if self._codec_pool:
+      return self._codec_pool.decode(path, data, metadata)
+    return self._decode(path, data, metadata)
+
+  def _encode(self, path, data):
+    if _aead_supported:
+      codec_id, data, outcome = self._compress(data)
+      return self._seal_data(path, data, codec_id), {}, outcome
+    checksum = self._build_checksum(path, data)
+    codec_id, data, outcome = self._compress(data)
+    data = self._encrypt_data(path, data, codec_id)
+    return data, {'checksum': checksum}, outcome
+
+  def _compress(self, data):
+    """Compress the given data if it is worth it. Returns the id of the
+    codec used, the resulting data and which of the compression stats
+    the attempt counts towards.
+    """
+    if not data or not self.codec.ident:
+      return 0, data, None
+    if not cloudnbd.codec.probe(data):
+      return 0, data, 'compress_skipped'
+    zipped = self.codec.compress(data)
+    if len(zipped) < len(data):
+      return self.codec.ident, zipped, 'compressed'
+    return 0, data, 'compress_wasted'
+
+  def _decode(self, path, data, metadata):
+    if data and ord(data[0]) & _aead_flag:
+      return self._open_data(path, data)
+    data = self._decrypt_data(path, data)
+    if metadata.get('checksum') != self._build_checksum(path, data):
+      raise BTChecksumError(
+       "remote and calculated checksums for object:%s don't match"
+       % path
+      )
+    return data
+
   def _build_checksum(self, path, data):
     """Calculate the checksum for given path anda data."""
     key = self.pass_key if path == 'config' else self.crypt_key
@@ -168,51 +477,122 @@ class BlockTree(object):
     """Decrypt the given data."""
     if not data:
       return None
-    zipped, size = struct.unpack_from(b'!BQ', data, 0)
-    data = data[struct.calcsize(b'!BQ'):]
+    flags, size = struct.unpack_from(b'!BQ', data, 0)
+    codec_id = flags & _codec_mask
     key = self.pass_key if path == 'config' else self.crypt_key
     hasher = hashlib.md5(cloudnbd._salt + path.encode('utf8'))
     iv = hasher.digest()
     decryptor = AES.new(key, AES.MODE_CBC, iv)
-    data = decryptor.decrypt(data)
-    data = data[:size]
+    data = decryptor.decrypt(memoryview(data)[_header_len:])
     magic_len = len(cloudnbd._crypt_magic)
-    magic = data[-magic_len:]
-    if magic != cloudnbd._crypt_magic:
+    if data[size - magic_len:size] != cloudnbd._crypt_magic:
       raise BTInvalidKey("decryption of '%s' failed possibly due to"
                          " invalid encryption key (or passphrase)"
                          % path)
-    data = data[:-magic_len]
-    if zipped:
-     data = zlib.decompress(data)
-    return data
+    if codec_id:
+      return cloudnbd.codec.decompress(
+        codec_id, buffer(data, 0, size - magic_len))
+    return data[:size - magic_len]
 
-  def _encrypt_data(self, path, data):
-    """Encrypt the given data."""
+  def _encrypt_data(self, path, data, flags = 0):
+    """Encrypt the given data, flags holding the id of the codec it
+    is compressed with.
+    """
     if not data:
       return None
-    zipped = zlib.compress(data)
-    if len(zipped) < len(data):
-      storezip = 1
-      data = zipped
-    else:
-      storezip = 0
-    data += cloudnbd._crypt_magic
-    header = struct.pack(b'!BQ', storezip, len(data))
-    data = data.ljust((len(data) // 32 + 1) * 32, b'\0')
+    # the header, data, magic and padding are laid out in one buffer
+    # which is then encrypted in place
+    size = len(data) + len(cloudnbd._crypt_magic)
+    buf = bytearray(_header_len + (size // 32 + 1) * 32)
+    struct.pack_into(b'!BQ', buf, 0, flags, size)
+    body = memoryview(buf)[_header_len:]
+    body[:len(data)] = data
+    body[len(data):size] = cloudnbd._crypt_magic
     key = self.pass_key if path == 'config' else self.crypt_key
     hasher = hashlib.md5(cloudnbd._salt + path.encode('utf8'))
     iv = hasher.digest()
     encryptor = AES.new(key, AES.MODE_CBC, iv)
-    data = encryptor.encrypt(data)
-    return header + data
+    _crypt_into(encryptor.encrypt, body, body)
+    return bytes(buf)
+
+  def _seal_data(self, path, data, flags = 0):
+    """Encrypt and authenticate the given data in a single pass, flags
+    holding the id of the codec it is compressed with.
+    """
+    if not data:
+      return None
+    # header, nonce, ciphertext and tag are laid out in one buffer
+    body = _header_len + _nonce_len
+    buf = bytearray(body + len(data) + _tag_len)
+    view = memoryview(buf)
+    struct.pack_into(b'!BQ', buf, 0, _aead_flag | flags, len(data))
+    nonce = os.urandom(_nonce_len)
+    view[_header_len:body] = nonce
+    key = self.pass_key if path == 'config' else self.crypt_key
+    sealer = AES.new(key, AES.MODE_GCM, nonce=nonce, mac_len=_tag_len)
+    sealer.update(view[:_header_len])
+    sealer.update(path.encode('utf8'))
+    _crypt_into(sealer.encrypt, data, view[body:body + len(data)])
+    view[body + len(data):] = sealer.digest()
+    return bytes(buf)
+
+  def _open_data(self, path, data):
+    """Decrypt and verify data sealed by _seal_data."""
+    if not _aead_supported:
+      raise BTError("'%s' is in a format which requires AES-GCM support"
+                    " from the crypto library" % path)
+    flags, size = struct.unpack_from(b'!BQ', data, 0)
+    body = _header_len + _nonce_len
+    view = memoryview(data)
+    if len(data) != body + size + _tag_len:
+      raise BTChecksumError("size of object:%s doesn't match its header"
+                            % path)
+    key = self.pass_key if path == 'config' else self.crypt_key
+    opener = AES.new(key, AES.MODE_GCM, nonce=view[_header_len:body],
+                     mac_len=_tag_len)
+    opener.update(view[:_header_len])
+    opener.update(path.encode('utf8'))
+    plain = opener.decrypt(view[body:body + size])
+    try:
+      opener.verify(data[body + size:])
+    except ValueError:
+      raise BTInvalidKey("authentication of '%s' failed possibly due to"
+                         " invalid encryption key (or passphrase) or"
+                         " corrupted data" % path)
+    codec_id = flags & _codec_mask
+    if codec_id:
+      return cloudnbd.codec.decompress(codec_id, plain)
+    return plain
 
   def get(self, path):
     """Get the value of an object."""
     return self._cache[path]
 
+  def fetch(self, path, cloud = None):
+    """Download the value of an object bypassing the cache, through
+    the given clone of the cloud if any.
+    """
+    return _indep_get(self, cloud if cloud else self.cloud, path)
+
+  def get_ref(self, path, cloud = None):
+    """Return the path of the content the object at path refers to, or
+    None if the object does not exist or holds its data itself.
+    """
+    obj = (cloud if cloud else self.cloud).get(path)
+    if not obj:
+      return None
+    data = obj.get_content()
+    if not (data and ord(data[0]) & _ref_flag):
+      return None
+    return 'data/%s' % self.decode(path, data, obj.metadata)
+
   def close(self):
     if self._writers_active:
       self._cache.set_wait_on_empty(False)
       for th in self._writers:
         th.join()
+    self.cloud.flush()
+    self.save_alloc()
+    if self._codec_pool:
+      self._codec_pool.close()
+      self._codec_pool = None
@@ -23,6 +23,9 @@ from __future__ import division
 import cloudnbd
 import time
 import threading
+import random
+import httplib
+import Queue
 
 class BridgeError(Exception):
   pass
@@ -32,6 +35,120 @@ class BridgeNoSuchBucket(BridgeError):
   pass
 class BridgeAccessNotChecked(BridgeError):
   pass
+class BridgeRetriesExhausted(BridgeError):
+  pass
+
+# bytes read at a time from the body of a GET
+_read_chunk_size = 2 ** 16
+
+# listed objects waiting to be consumed before the listing pauses
+_list_queue_size = 10000
+
+# seconds a lister waits on a full queue before checking whether the
+# listing has been abandoned
+_list_put_timeout = 1
+
+# HTTP statuses which are worth retrying on top of the 5xx ones
+_retry_statuses = frozenset([408, 429])
+
+_retry_stats_lock = threading.Lock()
+_retry_stats = {'retries': 0, 'gave_up': 0}
+
+def get_retry_stats():
+  """Return the retry counters of all the bridges in this process."""
+  with _retry_stats_lock:
+    return dict(_retry_stats)
+
+def _count_retry(name):
+  with _retry_stats_lock:
+    _retry_stats[name] += 1
+
+class ConnectionPool(object):
+  """Bounded pool of connections shared by the clones of a bridge, each
+  keeping its HTTP connection alive between requests. Connections are
+  created on demand, and once size of them exist, borrowers wait for
+  one to be given back.
+  """
+
+  def __init__(self, factory, size, close = None):
+    self._factory = factory
+    self._close = close
+    self._size = size
+    self._created = 0
+    self._idle = []
+    # signalled whenever a connection is given back or discarded, so
+    # waiters either take it or create one in place of it
+    self._changed = threading.Condition(threading.Lock())
+
+  def acquire(self):
+    with self._changed:
+      while not self._idle and self._created >= self._size:
+        self._changed.wait()
+      if self._idle:
+        return self._idle.pop()
+      self._created += 1
+    try:
+      return self._factory()
+    except:
+      with self._changed:
+        self._created -= 1
+        self._changed.notify()
+      raise
+
+  def release(self, conn):
+    with self._changed:
+      self._idle.append(conn)
+      self._changed.notify()
+
+  def add(self, conn):
+    """Put a connection made outside the pool into it."""
+    with self._changed:
+      self._created += 1
+      self._idle.append(conn)
+      self._changed.notify()
+
+  def discard(self, conn):
+    """Drop a connection which is in an unknown state."""
+    with self._changed:
+      self._created -= 1
+      self._changed.notify()
+    if self._close:
+      try:
+        self._close(conn)
+      except Exception:
+        pass
+
+def read_key(bucket, name):
+  """GET the boto key of the given name, streaming its body in chunks.
+  Returns the metadata and the content, which come from the one request.
+  """
+  key = bucket.new_key(name)
+  key.open_read()
+  try:
+    chunks = []
+    while True:
+      chunk = key.read(_read_chunk_size)
+      if not chunk:
+        break
+      chunks.append(chunk)
+  finally:
+    key.close()
+  return key.metadata, b''.join(chunks)
+
+def list_keys(request, prefix, marker):
+  """List the boto keys whose names start with prefix, starting after
+  marker. Each page is fetched through request(op), which runs op with a
+  bucket, so a page which fails is retried on its own.
+  """
+  while True:
+    page = request(lambda b: b.get_all_keys(prefix=prefix, marker=marker))
+    if not page:
+      return
+    for k in page:
+      yield k
+    if not page.is_truncated:
+      return
+    marker = page[-1].name
 
 class CloudObject(object):
   """A cloud object with content and metadata, initially however
@@ -48,6 +165,15 @@ class CloudObject(object):
 
 class Bridge(object):
   """Web service interface"""
+
+  # maximum number of connections the bridge and its clones keep open,
+  # None for the default
+  pool_size = None
+
+  # most objects delete_many() removes with a single request, None for
+  # any number of them
+  delete_batch_size = 1
+
   def __init__(self, access_key = None, bucket = None, volume = None):
     self.access_key = access_key
     self.bucket = bucket
@@ -67,22 +193,169 @@ class Bridge(object):
     """Get the value of the object given by the path."""
     raise NotImplementedError('abstract class')
 
+  def get_range(self, path, offset, length):
+    """Get length bytes of the content of the object given by the path
+    starting at offset, or None if there is no such object.
+    """
+    obj = self.get(path)
+    if obj is None:
+      return None
+    return obj.get_content()[offset:offset + length]
+
+  def exists(self, path):
+    """Determine whether the object given by the path exists."""
+    return self.get(path) is not None
+
   def set(self, path, content, metadata={}):
     """Set the value of the object given by the path."""
     raise NotImplementedError('abstract class')
 
-  def copy(self, src, target):
+  def copy(self, src, target, volume = None):
+    """Copy the object given by the path src to target on the cloud
+    side, target being in the given volume if any.
+    """
     raise NotImplementedError('abstract class')
 
   def delete(self, path):
     raise NotImplementedError('abstract class')
 
-  def list(self, prefix):
+  def delete_many(self, paths):
+    """Delete the objects given by the paths, in as few requests as the
+    storage allows. Missing objects are ignored. Without a batch delete
+    in the storage, the objects are deleted one by one.
+    """
+    for path in paths:
+      self.delete(path)
+
+  def list(self, prefix = '', marker = None):
+    """List the objects whose path starts with the given prefix, in the
+    order of their paths, starting after the path marker if given.
+    """
     raise NotImplementedError('abstract class')
 
+  def list_sharded(self, prefix = '', bounds = ()):
+    """List the objects like list() does, with the paths split at the
+    given bounds into shards which are listed concurrently, each on a
+    clone. Objects are yielded as they arrive, in no particular order.
+    """
+    bounds = sorted(set(b for b in bounds if b.startswith(prefix)))
+    starts = [None] + bounds
+    ends = bounds + [None]
+    name_start = len(self.volume) + 1
+    found = Queue.Queue(maxsize=_list_queue_size)
+    # set once the consumer is gone, so that the listers blocked on a
+    # full queue give up rather than wait on it forever
+    stop = threading.Event()
+    def put(item):
+      while not stop.is_set():
+        try:
+          found.put(item, timeout=_list_put_timeout)
+          return True
+        except Queue.Full:
+          pass
+      return False
+    def lister(cloud, start, end):
+      # the shard holds the paths after start, up to and including end
+      try:
+        for k in cloud.list(prefix, start):
+          if end is not None and k.name[name_start:] > end:
+            break
+          if not put(k):
+            return
+        put(None)
+      except Exception as e:
+        put(e)
+    for start, end in zip(starts, ends):
+      t = threading.Thread(target=lister,
+                           args=(self.clone(), start, end))
+      t.daemon = True
+      t.start()
+    running = len(starts)
+    try:
+      while running:
+        k = found.get()
+        if k is None:
+          running -= 1
+        elif isinstance(k, Exception):
+          raise k
+        else:
+          yield k
+    finally:
+      stop.set()
+
+  def flush(self):
+    """Make sure everything set so far is stored on the cloud."""
+    pass
+
+  def _new_pool(self, factory, close = None):
+    return ConnectionPool(
+      factory, self.pool_size or cloudnbd._default_connection_count, close)
+
+  def _pooled(self, op):
+    """Run op with a connection borrowed from the pool for the length
+    of the request, retrying on failures. A connection which failed
+    without a response from the server is dropped rather than put back.
+    """
+    def attempt():
+      conn = self._pool.acquire()
+      try:
+        result = op(conn)
+      except Exception as e:
+        if isinstance(getattr(e, 'status', None), int):
+          self._pool.release(conn)
+        else:
+          self._pool.discard(conn)
+        raise
+      self._pool.release(conn)
+      return result
+    return self._retry(attempt)
+
+  def _is_retryable(self, e):
+    """Determine whether the failed request which raised e may
+    succeed if tried again - throttling, server side and network errors
+    are retried, while anything else is taken to be permanent.
+    """
+    status = getattr(e, 'status', None)
+    if isinstance(status, int):
+      return status in _retry_statuses or status >= 500
+    return isinstance(e, (IOError, httplib.HTTPException))
+
+  def _retry(self, op):
+    """Run op until it succeeds, backing off exponentially with full
+    jitter between attempts so that throttled threads spread out. Errors
+    which are not retryable are raised right away, and once the retry
+    budget is used up, BridgeRetriesExhausted is raised.
+    """
+    attempt = 0
+    while True:
+      try:
+        return op()
+      except Exception as e:
+        if not self._is_retryable(e):
+          raise
+        attempt += 1
+        if attempt >= cloudnbd._retry_max_attempts:
+          _count_retry('gave_up')
+          raise BridgeRetriesExhausted(
+            'giving up after %d attempts: %s' % (attempt, e))
+        _count_retry('retries')
+      delay = min(cloudnbd._retry_max_delay,
+                  cloudnbd._retry_base_delay * 2 ** attempt)
+      time.sleep(random.uniform(0, delay))
+
 from cloudnbd.cloud import gs
+from cloudnbd.cloud import filesystem
+from cloudnbd.cloud import sim
+from cloudnbd.cloud import s3
+from cloudnbd.cloud import segment
+from cloudnbd.cloud import hedge
+from cloudnbd.cloud import throttle
+from cloudnbd.cloud import stripe
 
 backends = {
+  'file': filesystem.File,
   'gs': gs.GS,
-  's3': None
+  's3': s3.S3,
+  'sim': sim.Sim,
+  'stripe': stripe.Stripe
 }
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+#
+# filesystem.py - Local filesystem storage interface
+# Copyright (C) 2011  Mansour <mansour@oxplot.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import cloudnbd
+import os
+import errno
+import json
+import shutil
+from cloudnbd.cloud import *
+
+# Buckets are directories under the root directory given as the access
+# key, and objects are files under the directory of their volume. The
+# metadata of an object, if any, is kept in a hidden sidecar file next
+# to it. Each is written to a temporary file first and renamed into
+# place so readers never see a partially written file. The two renames
+# are not atomic as a pair though - a crash between them leaves the new
+# content next to the old metadata.
+
+def _meta_path(path):
+  head, tail = os.path.split(path)
+  return os.path.join(head, '.%s.meta' % tail)
+
+def _tmp_path(path):
+  head, tail = os.path.split(path)
+  return os.path.join(head, '.%s.%s.tmp'
+                      % (tail, os.urandom(4).encode('hex')))
+
+def _write_atomic(path, content):
+  tmp = _tmp_path(path)
+  with open(tmp, 'wb') as f:
+    f.write(content)
+    f.flush()
+    os.fsync(f.fileno())
+  os.rename(tmp, path)
+
+def _walk(local_dir, rel, marker = None):
+  """Yield the paths of the files under local_dir relative to the volume
+  along with their local paths, in the order of the relative paths,
+  starting after the path marker if given.
+  """
+  try:
+    names = os.listdir(local_dir)
+  except OSError as e:
+    if e.errno == errno.ENOENT:
+      return
+    raise
+  entries = []
+  for name in names:
+    if name.startswith('.'):
+      continue
+    local_path = os.path.join(local_dir, name)
+    if os.path.isdir(local_path):
+      entries.append((name + '/', local_path, True))
+    else:
+      entries.append((name, local_path, False))
+  for key, local_path, is_dir in sorted(entries):
+    path = rel + key
+    if marker is not None and path <= marker:
+      # a directory before the marker only holds paths before it too,
+      # unless the marker is in it
+      if is_dir and marker.startswith(path):
+        for item in _walk(local_path, path, marker):
+          yield item
+      continue
+    if is_dir:
+      for item in _walk(local_path, path):
+        yield item
+    else:
+      yield path, local_path
+
+def _unlink(path):
+  try:
+    os.unlink(path)
+  except OSError as e:
+    if e.errno != errno.ENOENT:
+      raise
+
+class FileObject(CloudObject):
+  """A file backed object with content and metadata, initially however
+  containing only the metadata.
+  """
+
+  def __init__(self, parent, nativeobj):
+    self._nativeobj = nativeobj
+    self._parent = parent
+    self.name, self._path = nativeobj
+    self._metadata = None
+
+  @property
+  def metadata(self):
+    if self._metadata is None:
+      try:
+        with open(_meta_path(self._path), 'rb') as f:
+          self._metadata = json.load(f)
+      except IOError as e:
+        if e.errno != errno.ENOENT:
+          raise
+        self._metadata = {}
+    return self._metadata
+
+  def get_content(self):
+    """Read the content of the this object."""
+    with open(self._path, 'rb') as f:
+      return f.read()
+
+class File(Bridge):
+  """Local directory interface - the access key is the path of the
+  directory holding the buckets.
+  """
+
+  def __init__(self, access_key = None, bucket = None, volume = None):
+    self.access_key = access_key
+    self.bucket = bucket
+    self.volume = volume
+    self._can_access = False
+
+  def check_access(self):
+    """Determine whether this instance with the given credentials is
+    able to access the storage.
+    """
+    self._root = os.path.join(os.path.expanduser(self.access_key),
+                              self.bucket)
+    if not os.path.isdir(self._root):
+      raise BridgeNoSuchBucket('Invalid bucket name given')
+    if not os.access(self._root, os.R_OK | os.W_OK | os.X_OK):
+      raise BridgeAccessDenied('No read/write access to the bucket')
+    self._can_access = True
+
+  def clone(self):
+    new_file = File(self.access_key, self.bucket, self.volume)
+    new_file._can_access = self._can_access
+    if new_file._can_access:
+      new_file._root = self._root
+    return new_file
+
+  def _local_path(self, path, volume = None):
+    return os.path.join(self._root, volume if volume else self.volume,
+                        *path.split('/'))
+
+  def get(self, path):
+    """Get the value of the object given by the path."""
+    self._ensure_access()
+    local_path = self._local_path(path)
+    if not os.path.isfile(local_path):
+      return None
+    return FileObject(
+      parent=self,
+      nativeobj=('%s/%s' % (self.volume, path), local_path)
+    )
+
+  def get_range(self, path, offset, length):
+    """Get length bytes of the content of the object given by the path
+    starting at offset, or None if there is no such object.
+    """
+    self._ensure_access()
+    try:
+      with open(self._local_path(path), 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+    except IOError as e:
+      if e.errno == errno.ENOENT:
+        return None
+      raise
+
+  def exists(self, path):
+    self._ensure_access()
+    return os.path.isfile(self._local_path(path))
+
+  def set(self, path, content, metadata={}):
+    """Set the value of the object given by the path."""
+    self._ensure_access()
+    local_path = self._local_path(path)
+    self._make_dirs(local_path)
+    _write_atomic(local_path, content)
+    if metadata:
+      _write_atomic(_meta_path(local_path), json.dumps(metadata))
+    else:
+      _unlink(_meta_path(local_path))
+
+  def copy(self, src, target, volume = None):
+    self._ensure_access()
+    src_path = self._local_path(src)
+    target_path = self._local_path(target, volume)
+    self._make_dirs(target_path)
+    # objects are never modified in place so they can share the data
+    for src_p, target_p in ((_meta_path(src_path),
+                             _meta_path(target_path)),
+                            (src_path, target_path)):
+      if not os.path.exists(src_p):
+        _unlink(target_p)
+        continue
+      tmp = _tmp_path(target_p)
+      try:
+        os.link(src_p, tmp)
+      except OSError:
+        shutil.copyfile(src_p, tmp)
+      os.rename(tmp, target_p)
+
+  def delete(self, path):
+    self._ensure_access()
+    local_path = self._local_path(path)
+    _unlink(local_path)
+    _unlink(_meta_path(local_path))
+
+  def list(self, prefix='', marker = None):
+    """List the objects whose path starts with the given prefix, in the
+    order of their paths.
+    """
+    self._ensure_access()
+    base = os.path.join(self._root, self.volume)
+    head = prefix.rpartition('/')[0]
+    top = os.path.join(base, *head.split('/')) if head else base
+    for path, local_path in _walk(top, head + '/' if head else '',
+                                  marker):
+      if path.startswith(prefix):
+        yield FileObject(
+          parent=self,
+          nativeobj=('%s/%s' % (self.volume, path), local_path)
+        )
+
+  def _make_dirs(self, local_path):
+    try:
+      os.makedirs(os.path.dirname(local_path))
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+
+  def _ensure_access(self):
+    if not self._can_access:
+      raise BridgeAccessNotChecked(
+        'check_access() must be called first'
+      )
@@ -36,23 +36,18 @@ if not config.has_section('Boto'):
 config.setbool('Boto', 'https_validate_certificates', True)
 
 class GSObject(CloudObject):
-  """A cloud object with content and metadata, initially however
-  containing only the metadata.
+  """A cloud object with content and metadata, the content having been
+  downloaded along with the metadata in a single request.
   """
 
   def __init__(self, parent, nativeobj):
     self._nativeobj = nativeobj
     self._parent = parent
-    self.metadata = nativeobj.metadata
+    self.name, self.metadata, self._content = nativeobj
 
   def get_content(self):
-    """Download the content of the this object."""
-    while True:
-      try:
-        return self._nativeobj.get_contents_as_string()
-      except: # XXX we might want to only catch certain errors here
-        pass 
-      time.sleep(1)
+    """Return the content of the this object."""
+    return self._content
 
 class GS(Bridge):
   """Web service interface"""
@@ -67,98 +62,109 @@ class GS(Bridge):
     able to access the storage.
     """
     self._access_key, self._secret_key = self.access_key.split(':')
-    from boto.gs.connection import GSConnection
     from boto.exception import GSResponseError
     try:
-      self._conn = GSConnection(self._access_key, self._secret_key)
-      self._bucket = self._conn.get_bucket(self.bucket)
+      conn = self._connect()
+      conn.get_bucket(self.bucket)
     except GSResponseError as e:
       if e.error_code == 'NoSuchBucket':
         raise BridgeNoSuchBucket('Invalid bucket name given')
       else: # e.error_code == 'AccessDenied':
         raise BridgeAccessDenied('Invalid access key specified bucket')
+    self._pool = self._new_pool(self._connect_bucket,
+                                lambda pooled: pooled[0].close())
+    self._pool.add((conn, self._bucket_of(conn)))
     self._can_access = True
 
+  def _connect(self):
+    from boto.gs.connection import GSConnection
+    return GSConnection(self._access_key, self._secret_key)
+
+  def _bucket_of(self, conn):
+    from boto.gs.bucket import Bucket
+    return Bucket(connection=conn, name=self.bucket)
+
+  def _connect_bucket(self):
+    conn = self._connect()
+    return conn, self._bucket_of(conn)
+
   def clone(self):
+    # all the clones share the pool of connections
     new_gs = GS()
     new_gs.access_key = self.access_key
-    new_gs._access_key = self._access_key
-    new_gs._secret_key = self._secret_key
     new_gs.bucket = self.bucket
     new_gs.volume = self.volume
     new_gs._can_access = self._can_access
     if new_gs._can_access:
-      from boto.gs.connection import GSConnection
-      from boto.gs.bucket import Bucket
-      new_gs._conn = GSConnection(self._access_key, self._secret_key)
-      new_gs._bucket = Bucket(
-        connection=new_gs._conn,
-        name=new_gs.bucket
-      )
+      new_gs._access_key = self._access_key
+      new_gs._secret_key = self._secret_key
+      new_gs._pool = self._pool
     return new_gs
 
-  def get(self, path):
-    """Get the value of the object given by the path."""
+  def _request(self, op):
+    """Run op with a pooled bucket, retrying on failures. Returns None
+    if the object is not found.
+    """
     self._ensure_access()
-    while True:
+    from boto.exception import GSResponseError
+    def pooled_op(pooled):
       try:
-        key = self._bucket.get_key('%s/%s' % (self.volume, path))
-        break
-      except: # XXX maybe specify some exceptions here
-        pass
-      time.sleep(1)
-    if key:
-      return GSObject(parent=self, nativeobj=key)
-    else:
+        return op(pooled[1])
+      except GSResponseError as e:
+        if e.status == 404:
+          return None
+        raise
+    return self._pooled(pooled_op)
+
+  def get(self, path):
+    """Get the value of the object given by the path."""
+    # a single GET brings the metadata along with the content, a 404
+    # meaning there is no such object
+    name = '%s/%s' % (self.volume, path)
+    found = self._request(lambda b: read_key(b, name))
+    if found is None:
       return None
+    return GSObject(parent=self, nativeobj=(name,) + found)
+
+  def get_range(self, path, offset, length):
+    """Get length bytes of the content of the object given by the path
+    starting at offset, or None if there is no such object.
+    """
+    headers = {'Range': 'bytes=%d-%d' % (offset, offset + length - 1)}
+    def op(bucket):
+      k = bucket.new_key('%s/%s' % (self.volume, path))
+      return k.get_contents_as_string(headers=headers)
+    return self._request(op)
+
+  def exists(self, path):
+    name = '%s/%s' % (self.volume, path)
+    return self._request(lambda b: b.get_key(name)) is not None
 
   def set(self, path, content, metadata={}):
     """Set the value of the object given by the path."""
-    self._ensure_access()
-    from boto.gs.key import Key
-    k = Key(self._bucket)
-    k.key = '%s/%s' % (self.volume, path)
-    k.metadata = metadata
-    while True:
-      try:
-        k.set_contents_from_string(content)
-        break
-      except: # XXX maybe specify some exceptions here
-        pass
-      time.sleep(1)
+    def op(bucket):
+      k = bucket.new_key('%s/%s' % (self.volume, path))
+      k.metadata = metadata
+      k.set_contents_from_string(content)
+    self._request(op)
 
-  def copy(self, src, target):
-    self._ensure_access()
-    while True:
-      try:
-        self._bucket.copy_key(
-          '%s/%s' % (self.volume, new_path),
-          self.bucket,
-          '%s/%s' % (self.volume, old_path)
-        )
-        break
-      except:
-        pass
-      time.sleep(1)
+  def copy(self, src, target, volume = None):
+    self._request(lambda b: b.copy_key(
+      '%s/%s' % (volume if volume else self.volume, target),
+      self.bucket,
+      '%s/%s' % (self.volume, src)
+    ))
 
   def delete(self, path):
-    self._ensure_access()
-    while True:
-      try:
-        self._bucket.delete_key('%s/%s' % (self.volume, path))
-        break
-      except:
-        pass
-      time.sleep(1)
+    self._request(lambda b: b.delete_key('%s/%s' % (self.volume, path)))
 
-  def list(self, prefix=''):
-    self._ensure_access()
-    while True:
-      try:
-        return self._bucket.list(prefix='%s/%s' % (self.volume, prefix))
-      except:
-        pass
-      time.sleep(1)
+  def list(self, prefix='', marker = None):
+    # a page at a time, each with a pooled connection held only for
+    # the request and retried on its own
+    if marker is not None:
+      marker = '%s/%s' % (self.volume, marker)
+    return list_keys(self._request, '%s/%s' % (self.volume, prefix),
+                     marker or '')
 
   def _ensure_access(self):
     if not self._can_access:
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+#
+# hedge.py - Hedged reads to cut the tail latency of the cloud
+# Copyright (C) 2011  Mansour <mansour@oxplot.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Hedged reads
+
+A read which has not completed once it has taken longer than a given
+percentile of the recent reads is sent again on another connection, and
+whichever copy completes first is used. The slow copy is left to finish
+on its own. Hedges are limited to a fraction of all reads so that a
+cloud which is slow across the board is not hit with twice the load.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import cloudnbd
+import collections
+import threading
+import Queue
+import time
+from cloudnbd.cloud import *
+
+class HedgedObject(CloudObject):
+  """A cloud object with content and metadata, the content having been
+  downloaded by whichever copy of the read completed first.
+  """
+
+  def __init__(self, parent, nativeobj):
+    self._nativeobj = nativeobj
+    self._parent = parent
+    self.name, self.metadata, self._content = nativeobj
+
+  def get_content(self):
+    """Return the content of the this object."""
+    return self._content
+
+class _State(object):
+  """Latencies and counters shared by all the clones of a HedgedBridge."""
+
+  def __init__(self, percentile):
+    self.percentile = percentile
+    self.lock = threading.Lock()
+    self.latencies = collections.deque(maxlen=cloudnbd._hedge_window)
+    self.stats = {'reads': 0, 'hedges': 0, 'hedge_wins': 0}
+
+  def delay(self):
+    """Return how long a read may take before it is hedged, or None if
+    it may not be hedged.
+    """
+    with self.lock:
+      self.stats['reads'] += 1
+      if len(self.latencies) < cloudnbd._hedge_min_samples:
+        return None
+      if self.stats['hedges'] >= \
+          self.stats['reads'] * cloudnbd._hedge_max_ratio:
+        return None
+      latencies = sorted(self.latencies)
+    index = int(len(latencies) * self.percentile / 100)
+    return latencies[min(index, len(latencies) - 1)]
+
+  def record(self, latency):
+    with self.lock:
+      self.latencies.append(latency)
+
+  def count(self, name):
+    with self.lock:
+      self.stats[name] += 1
+
+class HedgedBridge(Bridge):
+  """Hedge the reads of another Bridge. All other requests are passed
+  through.
+  """
+
+  def __init__(self, cloud, percentile = None, state = None):
+    self.cloud = cloud
+    self.access_key = cloud.access_key
+    self.bucket = cloud.bucket
+    self.volume = cloud.volume
+    self._state = state if state else _State(percentile)
+    self._can_access = True
+
+  def check_access(self):
+    self.cloud.check_access()
+
+  def clone(self):
+    return HedgedBridge(self.cloud.clone(), state=self._state)
+
+  def get_stats(self):
+    """Return the hedging counters shared by all the clones."""
+    with self._state.lock:
+      return dict(self._state.stats)
+
+  def _hedged(self, read):
+    """Run read(cloud) on the cloud, and once it has taken long enough,
+    on a clone of it as well. Returns the result of whichever completes
+    first, or raises the error of the first if both fail.
+    """
+    delay = self._state.delay()
+    if delay is None:
+      # the read can not be hedged so there is no need for a thread
+      start = time.time()
+      result = read(self.cloud)
+      self._state.record(time.time() - start)
+      return result
+    done = Queue.Queue()
+    def attempt(cloud, hedge):
+      start = time.time()
+      try:
+        result = read(cloud)
+      except Exception as e:
+        done.put((hedge, False, e))
+        return
+      self._state.record(time.time() - start)
+      done.put((hedge, True, result))
+    t = threading.Thread(target=attempt, args=(self.cloud, False))
+    t.daemon = True
+    t.start()
+    pending = 1
+    try:
+      hedge, ok, result = done.get(timeout=delay)
+    except Queue.Empty:
+      self._state.count('hedges')
+      t = threading.Thread(target=attempt,
+                           args=(self.cloud.clone(), True))
+      t.daemon = True
+      t.start()
+      pending += 1
+      hedge, ok, result = done.get()
+    pending -= 1
+    error = None
+    while not ok and pending:
+      error = error or result
+      hedge, ok, result = done.get()
+      pending -= 1
+    if not ok:
+      raise error or result
+    if hedge:
+      self._state.count('hedge_wins')
+    return result
+
+  def get(self, path):
+    def read(cloud):
+      obj = cloud.get(path)
+      if obj is None:
+        return None
+      return obj.metadata, obj.get_content()
+    found = self._hedged(read)
+    if found is None:
+      return None
+    return HedgedObject(parent=self,
+                        nativeobj=('%s/%s' % (self.volume, path),) + found)
+
+  def get_range(self, path, offset, length):
+    return self._hedged(
+      lambda cloud: cloud.get_range(path, offset, length))
+
+  def exists(self, path):
+    return self.cloud.exists(path)
+
+  def set(self, path, content, metadata={}):
+    return self.cloud.set(path, content, metadata=metadata)
+
+  def copy(self, src, target, volume = None):
+    return self.cloud.copy(src, target, volume)
+
+  def delete(self, path):
+    return self.cloud.delete(path)
+
+  def delete_many(self, paths):
+    return self.cloud.delete_many(paths)
+
+  def list(self, prefix='', marker = None):
+    return self.cloud.list(prefix, marker)
+
+  def flush(self):
+    self.cloud.flush()
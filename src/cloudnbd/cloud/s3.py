@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#
+# s3.py - Amazon S3 interface
+# Copyright (C) 2011  Mansour <mansour@oxplot.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import cloudnbd
+import time
+from cloudnbd.cloud import *
+
+# The access key is in the form <key>:<secret>[@<endpoint>] where the
+# optional endpoint of an S3 compatible service is <host>[:<port>],
+# prefixed by http:// for plain HTTP.
+
+def parse_access_key(access_key):
+  """Split the access key into the key, secret and the connection
+  arguments for the endpoint.
+  """
+  creds, _, endpoint = access_key.partition('@')
+  key, sep, secret = creds.partition(':')
+  if not sep:
+    raise BridgeAccessDenied('access key must be in the form'
+                             ' <key>:<secret>[@<endpoint>]')
+  kwargs = {}
+  if endpoint:
+    from boto.s3.connection import OrdinaryCallingFormat
+    if endpoint.startswith('http://'):
+      kwargs['is_secure'] = False
+      endpoint = endpoint[len('http://'):]
+    elif endpoint.startswith('https://'):
+      endpoint = endpoint[len('https://'):]
+    host, sep, port = endpoint.partition(':')
+    kwargs['host'] = host
+    if sep:
+      kwargs['port'] = int(port)
+    # S3 compatible services rarely support bucket names as hosts
+    kwargs['calling_format'] = OrdinaryCallingFormat()
+  return key, secret, kwargs
+
+# most keys a single multi-object delete request may carry
+_max_delete_keys = 1000
+
+class S3Object(CloudObject):
+  """A cloud object with content and metadata, the content having been
+  downloaded along with the metadata in a single request.
+  """
+
+  def __init__(self, parent, nativeobj):
+    self._nativeobj = nativeobj
+    self._parent = parent
+    self.name, self.metadata, self._content = nativeobj
+
+  def get_content(self):
+    """Return the content of the this object."""
+    return self._content
+
+class S3(Bridge):
+  """Web service interface"""
+
+  delete_batch_size = _max_delete_keys
+
+  def __init__(self, access_key = None, bucket = None, volume = None):
+    self.access_key = access_key
+    self.bucket = bucket
+    self.volume = volume
+    self._can_access = False
+
+  def check_access(self):
+    """Determine whether this instance with the given credentials is
+    able to access the storage.
+    """
+    self._key, self._secret, self._conn_args = \
+      parse_access_key(self.access_key)
+    from boto.exception import S3ResponseError
+    try:
+      conn = self._connect()
+      conn.get_bucket(self.bucket)
+    except S3ResponseError as e:
+      if e.error_code == 'NoSuchBucket':
+        raise BridgeNoSuchBucket('Invalid bucket name given')
+      else: # e.error_code == 'AccessDenied':
+        raise BridgeAccessDenied('Invalid access key specified bucket')
+    self._pool = self._new_pool(self._connect_bucket,
+                                lambda pooled: pooled[0].close())
+    self._pool.add((conn, conn.get_bucket(self.bucket, validate=False)))
+    self._can_access = True
+
+  def _connect(self):
+    from boto.s3.connection import S3Connection
+    return S3Connection(self._key, self._secret, **self._conn_args)
+
+  def _connect_bucket(self):
+    conn = self._connect()
+    return conn, conn.get_bucket(self.bucket, validate=False)
+
+  def clone(self):
+    # all the clones share the pool of connections
+    new_s3 = S3()
+    new_s3.access_key = self.access_key
+    new_s3.bucket = self.bucket
+    new_s3.volume = self.volume
+    new_s3._can_access = self._can_access
+    if new_s3._can_access:
+      new_s3._key = self._key
+      new_s3._secret = self._secret
+      new_s3._conn_args = self._conn_args
+      new_s3._pool = self._pool
+    return new_s3
+
+  def _request(self, op):
+    """Run op with a pooled bucket, retrying on failures. Returns None
+    if the object is not found.
+    """
+    self._ensure_access()
+    from boto.exception import S3ResponseError
+    def pooled_op(pooled):
+      try:
+        return op(pooled[1])
+      except S3ResponseError as e:
+        if e.status == 404:
+          return None
+        raise
+    return self._pooled(pooled_op)
+
+  def get(self, path):
+    """Get the value of the object given by the path."""
+    name = '%s/%s' % (self.volume, path)
+    found = self._request(lambda b: read_key(b, name))
+    if found is None:
+      return None
+    return S3Object(parent=self, nativeobj=(name,) + found)
+
+  def get_range(self, path, offset, length):
+    """Get length bytes of the content of the object given by the path
+    starting at offset, or None if there is no such object.
+    """
+    headers = {'Range': 'bytes=%d-%d' % (offset, offset + length - 1)}
+    def op(bucket):
+      key = bucket.new_key('%s/%s' % (self.volume, path))
+      return key.get_contents_as_string(headers=headers)
+    return self._request(op)
+
+  def exists(self, path):
+    name = '%s/%s' % (self.volume, path)
+    return self._request(lambda b: b.get_key(name)) is not None
+
+  def set(self, path, content, metadata={}):
+    """Set the value of the object given by the path."""
+    def op(bucket):
+      k = bucket.new_key('%s/%s' % (self.volume, path))
+      k.metadata = dict(metadata)
+      k.set_contents_from_string(content)
+    self._request(op)
+
+  def copy(self, src, target, volume = None):
+    self._request(lambda b: b.copy_key(
+      '%s/%s' % (volume if volume else self.volume, target),
+      self.bucket,
+      '%s/%s' % (self.volume, src)
+    ))
+
+  def delete(self, path):
+    self._request(lambda b: b.delete_key('%s/%s' % (self.volume, path)))
+
+  def delete_many(self, paths):
+    """Delete the objects with multi-object delete requests. Keys which
+    fail to be deleted in a batch are retried one by one.
+    """
+    names = ['%s/%s' % (self.volume, p) for p in paths]
+    for i in xrange(0, len(names), _max_delete_keys):
+      batch = names[i:i + _max_delete_keys]
+      result = self._request(lambda b: b.delete_keys(batch, quiet=True))
+      for error in result.errors:
+        if error.code != 'NoSuchKey':
+          self.delete(error.key[len(self.volume) + 1:])
+
+  def list(self, prefix='', marker = None):
+    # a page at a time, each with a pooled connection held only for
+    # the request and retried on its own
+    if marker is not None:
+      marker = '%s/%s' % (self.volume, marker)
+    return list_keys(self._request, '%s/%s' % (self.volume, prefix),
+                     marker or '')
+
+  def _ensure_access(self):
+    if not self._can_access:
+      raise BridgeAccessNotChecked(
+        'check_access() must be called first'
+      )
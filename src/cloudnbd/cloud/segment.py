@@ -0,0 +1,485 @@
+#!/usr/bin/env python
+#
+# segment.py - Log structured packing of blocks into segment objects
+# Copyright (C) 2011  Mansour <mansour@oxplot.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Segment layout
+
+Instead of one object per block, blocks are appended to large segment
+objects (segments/<id>) as they are written. Each segment ends with
+an index of the blocks it holds (or deletes) followed by the length of
+the index:
+
+  <block>...<block><json index><!Q index length>
+
+The location of every block is kept in a map which is persisted as its
+own object (segmap) from time to time. The map records the id of the
+first segment which was not yet on the cloud when it was saved, so
+segments from that id on are replayed from their index when the volume
+is opened after a crash.
+
+Overwritten blocks leave dead space in their old segments. A compactor
+copies the live blocks of mostly dead segments into the current one
+and deletes the old segments once the map no longer refers to them.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import cloudnbd
+import heapq
+import re
+import json
+import zlib
+import struct
+import time
+import threading
+from cloudnbd.cloud import *
+
+_block_pat = re.compile(r'^(.*?blocks/)(\d+)$')
+_map_path = 'segmap'
+_segment_path = 'segments/%d'
+_segment_pat = re.compile(r'^segments/(\d+)$')
+
+# index entry fields
+_SEG = 0
+_OFF = 1
+_LEN = 2
+_META = 3
+
+class SegmentObject(CloudObject):
+  """A block stored inside a segment."""
+
+  def __init__(self, parent, nativeobj):
+    self._parent = parent
+    self._nativeobj = nativeobj
+    self.metadata = nativeobj[1][_META]
+
+  def get_content(self):
+    return self._parent._read_entry(*self._nativeobj)
+
+class _ListedBlock(object):
+  def __init__(self, name):
+    self.name = name
+
+class _Segment(object):
+  """A segment which is being filled or uploaded."""
+
+  def __init__(self, ident):
+    self.ident = ident
+    self.chunks = []
+    self.size = 0
+    self.index = {}
+    self.created = time.time()
+
+class _State(object):
+  """Layout state shared by all the clones of a SegmentBridge."""
+
+  def __init__(self, segment_size):
+    self.segment_size = segment_size
+    self.lock = threading.RLock()
+    self.upload_done = threading.Condition(self.lock)
+    # held for the whole of a save of the map so that saves, each of a
+    # snapshot of the state, reach the cloud in order
+    self.save_lock = threading.Lock()
+    # block locations as of the segments which are on the cloud
+    self.durable = {}
+    # block locations in the segments which are not yet on the cloud
+    # and the data of those blocks
+    self.volatile = {}
+    self.pending = {}
+    # per segment: live bytes, number of durable entries and total size
+    self.live = {}
+    self.refs = {}
+    self.sizes = {}
+    self.open = None
+    self.inflight = set()
+    self.next_id = 0
+    self.uploaded_count = 0
+    self.loaded = False
+
+  def current(self, path):
+    return self.volatile.get(path) or self.durable.get(path)
+
+  def first_volatile(self):
+    """Id of the first segment which is not on the cloud yet."""
+    if self.inflight:
+      return min(self.inflight)
+    if self.open:
+      return self.open.ident
+    return self.next_id
+
+class SegmentBridge(Bridge):
+  """Store blocks packed into large segment objects on top of another
+  Bridge. All other objects are passed through.
+  """
+
+  def __init__(self, cloud, segment_size = None, state = None):
+    self.cloud = cloud
+    self.access_key = cloud.access_key
+    self.bucket = cloud.bucket
+    self.volume = cloud.volume
+    if segment_size is None:
+      segment_size = cloudnbd._default_segment_size
+    self._state = state if state else _State(segment_size)
+    self._can_access = True
+
+  def check_access(self):
+    self.cloud.check_access()
+
+  def clone(self):
+    return SegmentBridge(self.cloud.clone(), state=self._state)
+
+  def get(self, path):
+    if not _block_pat.match(path):
+      return self.cloud.get(path)
+    self._ensure_loaded()
+    with self._state.lock:
+      entry = self._state.current(path)
+    if entry is None or entry[_LEN] is None:
+      return None
+    return SegmentObject(parent=self, nativeobj=(path, entry))
+
+  def exists(self, path):
+    if not _block_pat.match(path):
+      return self.cloud.exists(path)
+    return self.get(path) is not None
+
+  def set(self, path, content, metadata={}):
+    if not _block_pat.match(path):
+      return self.cloud.set(path, content, metadata=metadata)
+    self._append(path, content, metadata)
+
+  def delete(self, path):
+    if not _block_pat.match(path):
+      return self.cloud.delete(path)
+    self._append(path, None, None)
+
+  def delete_many(self, paths):
+    others = []
+    for path in paths:
+      if _block_pat.match(path):
+        self._append(path, None, None)
+      else:
+        others.append(path)
+    if others:
+      self.cloud.delete_many(others)
+
+  def copy(self, src, target, volume = None):
+    if not _block_pat.match(src):
+      return self.cloud.copy(src, target, volume)
+    if volume and volume != self.volume:
+      raise BridgeError('blocks can not be copied to another volume'
+                        ' through the segment layout')
+    obj = self.get(src)
+    if obj:
+      self.set(target, obj.get_content(), metadata=obj.metadata)
+
+  def list(self, prefix='', marker = None):
+    """List the blocks in the segments along with the other objects
+    under prefix, all in path order.
+    """
+    self._ensure_loaded()
+    st = self._state
+    with st.lock:
+      paths = set(st.durable)
+      paths.update(st.volatile)
+      paths = [p for p in paths if p.startswith(prefix)
+               and (marker is None or p > marker)
+               and st.current(p)[_LEN] is not None]
+    blocks = [_ListedBlock('%s/%s' % (self.volume, p))
+              for p in sorted(paths)]
+    if _block_pat.match(prefix + '0'):
+      return blocks
+    # blocks are only ever stored in the segments, so the objects on the
+    # cloud are all others
+    return _merge_listings(self.cloud.list(prefix, marker), blocks)
+
+  def flush(self):
+    """Upload the current segment and save the map."""
+    self._ensure_loaded()
+    self._seal_open()
+    self._wait_uploads()
+    self._save_map()
+    self.cloud.flush()
+
+  # loading and saving of the map
+
+  def load(self):
+    """Load the map and replay the segments which were written after
+    it was last saved.
+    """
+    st = self._state
+    with st.lock:
+      if st.loaded:
+        return
+      obj = self.cloud.get(_map_path)
+      if obj:
+        saved = json.loads(zlib.decompress(obj.get_content()))
+        st.next_id = saved['next']
+        for seg_id, size in saved['sizes'].iteritems():
+          st.sizes[int(seg_id)] = size
+        for path, entry in saved['blocks'].iteritems():
+          self._apply_durable(path, tuple(entry))
+      # a segment may have been uploaded before an earlier one which
+      # never made it, so all the segments from next on are replayed
+      # and the ids of none of them are reused
+      start = len(self.volume) + 1
+      seg_ids = []
+      for k in self.cloud.list('segments/'):
+        m = _segment_pat.match(k.name[start:])
+        if m and int(m.group(1)) >= st.next_id:
+          seg_ids.append(int(m.group(1)))
+      for seg_id in sorted(seg_ids):
+        data = self._get_segment(seg_id)
+        if data is None:
+          continue
+        st.sizes[seg_id] = len(data)
+        for path, e in _segment_index(data).iteritems():
+          self._apply_durable(path, (seg_id,) + tuple(e))
+      if seg_ids:
+        st.next_id = max(st.next_id, max(seg_ids) + 1)
+      if st.refs:
+        st.next_id = max(st.next_id, max(st.refs) + 1)
+      st.loaded = True
+
+  def _ensure_loaded(self):
+    if not self._state.loaded:
+      self.load()
+
+  def _save_map(self):
+    st = self._state
+    with st.save_lock:
+      with st.lock:
+        first_volatile = st.first_volatile()
+        durable = st.durable.items()
+        sizes = dict(st.sizes)
+        doomed = [s for s, c in st.refs.iteritems()
+                  if c == 0 and st.live.get(s, 0) == 0
+                  and s < first_volatile]
+      # deletes in the segments before first_volatile are final so
+      # they are not needed in the map - those from the later segments
+      # are replayed on load anyway
+      blocks = dict((p, list(e)) for p, e in durable
+                    if e[_LEN] is not None or e[_SEG] >= first_volatile)
+      saved = {'next': first_volatile, 'blocks': blocks, 'sizes': sizes}
+      self.cloud.set(_map_path, zlib.compress(json.dumps(saved)))
+      with st.lock:
+        for path, e in durable:
+          if e[_LEN] is None and e[_SEG] < first_volatile \
+             and st.durable.get(path) == e:
+            del st.durable[path]
+            st.refs[e[_SEG]] -= 1
+      # the saved map no longer refers to the segments without live
+      # data
+      for seg_id in doomed:
+        self.cloud.delete(_segment_path % seg_id)
+        with st.lock:
+          del st.refs[seg_id]
+          st.live.pop(seg_id, None)
+          st.sizes.pop(seg_id, None)
+
+  def _get_segment(self, seg_id):
+    obj = self.cloud.get(_segment_path % seg_id)
+    return obj.get_content() if obj else None
+
+  # block bookkeeping - the state lock must be held
+
+  def _apply_durable(self, path, entry):
+    """Record that the given location of path is on the cloud, unless a
+    newer location is already recorded.
+    """
+    st = self._state
+    old = st.durable.get(path)
+    if old is not None and old[_SEG] > entry[_SEG]:
+      return
+    # while there is a volatile location for the path, the live bytes
+    # have already been accounted for when it was appended
+    loading = path not in st.volatile
+    if old is not None:
+      st.refs[old[_SEG]] -= 1
+      if loading and old[_LEN] is not None:
+        st.live[old[_SEG]] -= old[_LEN]
+    st.durable[path] = entry
+    st.refs[entry[_SEG]] = st.refs.get(entry[_SEG], 0) + 1
+    st.live.setdefault(entry[_SEG], 0)
+    if loading and entry[_LEN] is not None:
+      st.live[entry[_SEG]] += entry[_LEN]
+
+  # writing
+
+  def _append(self, path, content, metadata, expect = None):
+    """Append the content of path to the open segment (a delete when
+    content is None) - if expect is given, only if it is still the
+    current location of path.
+    """
+    self._ensure_loaded()
+    st = self._state
+    with st.lock:
+      old = st.current(path)
+      if expect is not None and old != expect:
+        return
+      if st.open is None:
+        st.open = _Segment(st.next_id)
+        st.next_id += 1
+      seg = st.open
+      if old is not None and old[_LEN] is not None:
+        st.live[old[_SEG]] -= old[_LEN]
+      if content is None:
+        entry = (seg.ident, 0, None, None)
+        st.pending.pop(path, None)
+      else:
+        entry = (seg.ident, seg.size, len(content), metadata or {})
+        seg.chunks.append(content)
+        seg.size += len(content)
+        st.live[seg.ident] = st.live.get(seg.ident, 0) + len(content)
+        st.pending[path] = (entry, content)
+      seg.index[path] = list(entry[1:])
+      st.volatile[path] = entry
+      full = self._take_open() \
+        if seg.size >= st.segment_size else None
+    if full:
+      self._upload(full)
+
+  def _take_open(self):
+    st = self._state
+    seg = st.open
+    st.open = None
+    if seg is not None:
+      st.inflight.add(seg.ident)
+    return seg
+
+  def _seal_open(self):
+    with self._state.lock:
+      seg = self._take_open()
+    if seg:
+      self._upload(seg)
+
+  def _upload(self, seg):
+    st = self._state
+    index = json.dumps(seg.index)
+    seg.chunks.append(index)
+    seg.chunks.append(struct.pack(b'!Q', len(index)))
+    data = b''.join(seg.chunks)
+    self.cloud.set(_segment_path % seg.ident, data)
+    with st.lock:
+      st.inflight.discard(seg.ident)
+      st.sizes[seg.ident] = len(data)
+      for path, e in seg.index.iteritems():
+        entry = (seg.ident,) + tuple(e)
+        self._apply_durable(path, entry)
+        if st.volatile.get(path) == entry:
+          del st.volatile[path]
+          if st.pending.get(path, (None,))[0] == entry:
+            del st.pending[path]
+      st.uploaded_count += 1
+      save = st.uploaded_count % cloudnbd._segmap_save_interval == 0
+      st.upload_done.notify_all()
+    if save:
+      self._save_map()
+
+  def _wait_uploads(self):
+    st = self._state
+    with st.lock:
+      while st.inflight:
+        st.upload_done.wait()
+
+  # reading
+
+  def _read_entry(self, path, entry):
+    st = self._state
+    with st.lock:
+      pending = st.pending.get(path)
+      if pending and pending[0] == entry:
+        return pending[1]
+      while entry[_SEG] in st.inflight \
+            or st.open and st.open.ident == entry[_SEG]:
+        # overwritten while its segment is still being uploaded
+        st.upload_done.wait()
+    return self.cloud.get_range(_segment_path % entry[_SEG],
+                                entry[_OFF], entry[_LEN])
+
+  # maintenance
+
+  def start_maintenance(self):
+    """Start a thread which uploads idle segments and compacts the ones
+    which are mostly dead space.
+    """
+    th = threading.Thread(target=self._maintenance_worker)
+    th.daemon = True
+    th.start()
+
+  def _maintenance_worker(self):
+    cloud = self.clone()
+    last_compact = time.time()
+    while True:
+      time.sleep(1)
+      st = self._state
+      with st.lock:
+        idle = st.open is not None and time.time() - st.open.created \
+          > cloudnbd._segment_flush_interval
+      if idle:
+        cloud._seal_open()
+      if time.time() - last_compact > cloudnbd._segment_compact_interval:
+        cloud.compact()
+        last_compact = time.time()
+
+  def compact(self):
+    """Move the live blocks of mostly dead segments into the open
+    segment so the old ones can be deleted.
+    """
+    self._ensure_loaded()
+    st = self._state
+    with st.lock:
+      first_volatile = st.first_volatile()
+      victims = [s for s, live in st.live.iteritems()
+                 if s < first_volatile and s in st.sizes
+                 and live < st.sizes[s]
+                   * cloudnbd._segment_compact_ratio]
+    if not victims:
+      return
+    for seg_id in sorted(victims):
+      data = self._get_segment(seg_id)
+      if data is None:
+        continue
+      for path, e in _segment_index(data).iteritems():
+        entry = (seg_id,) + tuple(e)
+        if entry[_LEN] is not None:
+          self._append(path, data[entry[_OFF]:entry[_OFF] + entry[_LEN]],
+                       entry[_META], expect=entry)
+    self._seal_open()
+    self._wait_uploads()
+    self._save_map()
+
+def _merge_listings(*listings):
+  """Merge listings, each in path order, into one in path order."""
+  keyed = [((k.name, k) for k in listing) for listing in listings]
+  for name, k in heapq.merge(*keyed):
+    yield k
+
+def _segment_index(data):
+  index_len, = struct.unpack_from(b'!Q', data, len(data) - 8)
+  return json.loads(data[-8 - index_len:-8])
+
+def open_layout(cloud, config):
+  """Return the Bridge to access the blocks of a volume through
+  according to its config.
+  """
+  if config.get('layout') == 'segment':
+    cloud = SegmentBridge(cloud, config.get('segment_size'))
+    cloud.load()
+  return cloud
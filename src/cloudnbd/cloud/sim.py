@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+#
+# sim.py - Simulated storage with configurable latency and faults
+# Copyright (C) 2011  Mansour <mansour@oxplot.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import cloudnbd
+import random
+import threading
+import time
+from cloudnbd.cloud import *
+from cloudnbd.cloud import filesystem
+
+# The access key configures the simulation as comma separated
+# <name>=<value> pairs:
+#
+#   latency      median latency of a request in seconds
+#   sigma        spread of the log-normal latency distribution
+#   bandwidth    bytes per second shared by all transfers, 0 for no
+#                limit - K, M and G suffixes are accepted
+#   concurrency  requests a connection (a clone) may have in flight at
+#                once, 0 for no limit
+#   errors       probability of a request failing transiently - failed
+#                requests are retried by the retry policy of Bridge
+#   seed         seed of the random generator for repeatable runs
+#   dir          keep the objects in this directory instead of memory,
+#                so they outlive the process
+#
+# e.g. latency=0.08,bandwidth=10M,concurrency=4,errors=0.01,seed=1
+
+_defaults = {
+  'latency': 0.05,
+  'sigma': 0.5,
+  'bandwidth': 0,
+  'concurrency': 0,
+  'errors': 0.0,
+  'seed': None,
+  'dir': None
+}
+
+_units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+
+class SimTransientError(IOError):
+  pass
+
+def parse_config(spec):
+  """Parse the simulation parameters from the access key."""
+  config = dict(_defaults)
+  for item in filter(None, (spec or '').split(',')):
+    name, sep, value = item.partition('=')
+    name = name.strip()
+    if not sep or name not in _defaults:
+      raise BridgeAccessDenied("invalid simulation parameter '%s'"
+                               % item)
+    value = value.strip()
+    try:
+      if name == 'dir':
+        config[name] = value
+      elif name in ('concurrency', 'seed'):
+        config[name] = int(value)
+      elif name == 'bandwidth':
+        mult = _units.get(value[-1:].upper(), 1)
+        if mult > 1:
+          value = value[:-1]
+        config[name] = int(float(value) * mult)
+      else:
+        config[name] = float(value)
+    except ValueError:
+      raise BridgeAccessDenied(
+        "invalid value for simulation parameter '%s'" % name)
+  return config
+
+class _Link(object):
+  """State shared by all the connections of a simulated cloud."""
+
+  def __init__(self, config):
+    self.config = config
+    self.lock = threading.Lock()
+    self.random = random.Random(config['seed'])
+    self.free_at = 0
+    self.objects = {}
+    self.stats = {'requests': 0, 'errors': 0, 'bytes': 0}
+
+  def latency(self):
+    with self.lock:
+      sample = self.random.lognormvariate(0, self.config['sigma'])
+      failed = self.random.random() < self.config['errors']
+    return self.config['latency'] * sample, failed
+
+  def transfer(self, size):
+    """Sleep for as long as sending size bytes takes over the link,
+    queuing behind the transfers already in progress.
+    """
+    bandwidth = self.config['bandwidth']
+    with self.lock:
+      self.stats['bytes'] += size
+      if not bandwidth:
+        return
+      start = max(time.time(), self.free_at)
+      self.free_at = start + size / bandwidth
+      done = self.free_at
+    delay = done - time.time()
+    if delay > 0:
+      time.sleep(delay)
+
+# simulated clouds by the access key and the bucket, so all the
+# connections to one in a process share its objects
+_links = {}
+_links_lock = threading.Lock()
+
+class SimObject(CloudObject):
+  """A simulated cloud object with content and metadata, the content
+  having been downloaded along with the metadata in a single request.
+  """
+
+  def __init__(self, parent, nativeobj):
+    self._nativeobj = nativeobj
+    self._parent = parent
+    self.name, self.metadata, self._content = nativeobj
+
+  def get_content(self):
+    """Return the content of the this object."""
+    return self._content
+
+class SimListedObject(CloudObject):
+  """A listed simulated cloud object with metadata, whose content takes
+  a request of its own to download.
+  """
+
+  def __init__(self, parent, nativeobj):
+    self._nativeobj = nativeobj
+    self._parent = parent
+    self.name, self.metadata, self._get_content = nativeobj
+
+  def get_content(self):
+    """Download the content of the this object."""
+    content = self._parent._request(self._get_content)
+    self._parent._link.transfer(len(content))
+    return content
+
+class Sim(Bridge):
+  """In memory cloud which behaves like a remote one - requests take
+  time, share a limited bandwidth and occasionally fail.
+  """
+
+  # the whole of delete_many() is a single request
+  delete_batch_size = None
+
+  def __init__(self, access_key = None, bucket = None, volume = None):
+    self.access_key = access_key
+    self.bucket = bucket
+    self.volume = volume
+    self._can_access = False
+
+  def check_access(self):
+    """Determine whether this instance with the given credentials is
+    able to access the storage.
+    """
+    config = parse_config(self.access_key)
+    with _links_lock:
+      key = (self.access_key, self.bucket)
+      if key not in _links:
+        _links[key] = _Link(config)
+      self._link = _links[key]
+    self._store = None
+    if config['dir']:
+      self._store = filesystem.File(config['dir'], self.bucket,
+                                    self.volume)
+      self._store.check_access()
+    self._slots = None
+    if config['concurrency']:
+      self._slots = threading.Semaphore(config['concurrency'])
+    self._can_access = True
+
+  def clone(self):
+    new_sim = Sim(self.access_key, self.bucket, self.volume)
+    if self._can_access:
+      new_sim.check_access()
+    return new_sim
+
+  def get_stats(self):
+    """Return the request counters shared by all the connections."""
+    with self._link.lock:
+      return dict(self._link.stats)
+
+  def _request(self, op):
+    """Run op as a simulated request, retrying injected failures."""
+    self._ensure_access()
+    def attempt():
+      if self._slots:
+        self._slots.acquire()
+      try:
+        delay, failed = self._link.latency()
+        time.sleep(delay)
+        with self._link.lock:
+          self._link.stats['requests'] += 1
+          if failed:
+            self._link.stats['errors'] += 1
+        if failed:
+          raise SimTransientError('simulated transient failure')
+        return op()
+      finally:
+        if self._slots:
+          self._slots.release()
+    return self._retry(attempt)
+
+  def _name(self, path, volume = None):
+    return '%s/%s' % (volume if volume else self.volume, path)
+
+  def get(self, path):
+    """Get the value of the object given by the path."""
+    # like the real clouds, a single GET brings the metadata along with
+    # the content
+    def op():
+      if self._store:
+        obj = self._store.get(path)
+        if obj is None:
+          return None
+        return obj.metadata, obj.get_content()
+      with self._link.lock:
+        entry = self._link.objects.get(self._name(path))
+      if entry is None:
+        return None
+      return entry[1], entry[0]
+    found = self._request(op)
+    if found is None:
+      return None
+    self._link.transfer(len(found[1]))
+    return SimObject(parent=self,
+                     nativeobj=(self._name(path),) + found)
+
+  def get_range(self, path, offset, length):
+    """Get length bytes of the content of the object given by the path
+    starting at offset, or None if there is no such object.
+    """
+    def op():
+      if self._store:
+        return self._store.get_range(path, offset, length)
+      with self._link.lock:
+        entry = self._link.objects.get(self._name(path))
+      if entry is None:
+        return None
+      return entry[0][offset:offset + length]
+    content = self._request(op)
+    if content is not None:
+      self._link.transfer(len(content))
+    return content
+
+  def set(self, path, content, metadata={}):
+    """Set the value of the object given by the path."""
+    def op():
+      self._link.transfer(len(content))
+      if self._store:
+        return self._store.set(path, content, metadata=metadata)
+      with self._link.lock:
+        self._link.objects[self._name(path)] = \
+          (bytes(content), dict(metadata))
+    self._request(op)
+
+  def copy(self, src, target, volume = None):
+    def op():
+      if self._store:
+        return self._store.copy(src, target, volume)
+      with self._link.lock:
+        entry = self._link.objects.get(self._name(src))
+        if entry is not None:
+          self._link.objects[self._name(target, volume)] = entry
+    self._request(op)
+
+  def delete(self, path):
+    def op():
+      if self._store:
+        return self._store.delete(path)
+      with self._link.lock:
+        self._link.objects.pop(self._name(path), None)
+    self._request(op)
+
+  def delete_many(self, paths):
+    # as a single batch request
+    def op():
+      if self._store:
+        return self._store.delete_many(paths)
+      with self._link.lock:
+        for path in paths:
+          self._link.objects.pop(self._name(path), None)
+    self._request(op)
+
+  def list(self, prefix='', marker = None):
+    def op():
+      if self._store:
+        return [SimListedObject(parent=self, nativeobj=(
+                  k.name, k.metadata, lambda k=k: k.get_content()))
+                for k in self._store.list(prefix, marker)]
+      start = self._name(prefix)
+      after = self._name(marker) if marker is not None else ''
+      with self._link.lock:
+        items = sorted((name, entry)
+                       for name, entry in self._link.objects.items()
+                       if name.startswith(start) and name > after)
+      return [SimListedObject(parent=self, nativeobj=(
+                name, entry[1], lambda entry=entry: entry[0]))
+              for name, entry in items]
+    return self._request(op)
+
+  def _ensure_access(self):
+    if not self._can_access:
+      raise BridgeAccessNotChecked(
+        'check_access() must be called first'
+      )
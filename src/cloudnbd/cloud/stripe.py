@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+#
+# stripe.py - Striping and mirroring a volume across buckets
+# Copyright (C) 2011  Mansour <mansour@oxplot.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Striping
+
+A striped volume is spread over several members, each a bucket of
+another backend, optionally with a prefix to the name of the volume in
+it. Numbered objects (blocks/N, segments/N and the blocks of layers) go
+to member N modulo the number of members, content addressed objects
+(data/<hash>) go by their hash, and all others live on the first
+member.
+
+A member may itself be a mirror of several buckets. Mirrors write to
+all of their buckets at once and read from the one which has been the
+fastest lately, falling back to the others if it fails or does not
+have the object.
+
+The access key is <backend>:<access key of the backend>, and the bucket
+lists the members separated by ',', the buckets of a mirror separated
+by '+', each with an optional prefix after '#':
+
+  b1,b2,b3        stripe over three buckets
+  b1+b2           mirror over two buckets
+  b1+b2,b3+b4     stripe over two mirrors
+  b1#x,b1#y       stripe over two prefixes of the same bucket
+
+The members and their order must stay the same for the life of the
+volume.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import cloudnbd
+import heapq
+import re
+import threading
+import time
+from cloudnbd.cloud import *
+
+_numbered_pat = re.compile(r'^(?:.*/)?(?:blocks|segments)/(\d+)$')
+_hashed_pat = re.compile(r'^data/([0-9a-f]{1,8})')
+
+# weight of the latest read in the running latency of a mirror bucket,
+# and the seconds it takes for a latency which is not updated to halve
+# so that a bucket which was slow for a while gets tried again
+_latency_weight = 0.2
+_latency_half_life = 60
+
+def parse_members(bucket):
+  """Split the bucket into the members, each a list of the buckets of a
+  mirror along with their prefixes.
+  """
+  members = []
+  for member in bucket.split(','):
+    mirror = []
+    for replica in member.split('+'):
+      name, _, prefix = replica.partition('#')
+      if not name:
+        raise BridgeNoSuchBucket("invalid stripe bucket '%s'" % bucket)
+      mirror.append((name, prefix))
+    members.append(mirror)
+  return members
+
+def member_index(path, count):
+  """Return the index of the member holding the object at path."""
+  m = _numbered_pat.match(path)
+  if m:
+    return int(m.group(1)) % count
+  m = _hashed_pat.match(path)
+  if m:
+    return int(m.group(1), 16) % count
+  return 0
+
+class _ListedObject(object):
+  """An object listed from a member, named as if it were in the striped
+  or mirrored volume.
+  """
+
+  def __init__(self, name, obj):
+    self.name = name
+    self._obj = obj
+    self.metadata = getattr(obj, 'metadata', None)
+
+  def get_content(self):
+    return self._obj.get_content()
+
+class _Latencies(object):
+  """Running read latencies of the buckets of a mirror, shared by all
+  its clones.
+  """
+
+  def __init__(self, count):
+    self.lock = threading.Lock()
+    self.values = [0.0] * count
+    self.stamps = [time.time()] * count
+
+  def _value(self, index, now):
+    return self.values[index] \
+      * 0.5 ** ((now - self.stamps[index]) / _latency_half_life)
+
+  def order(self):
+    """Return the indexes of the buckets, the fastest first."""
+    now = time.time()
+    with self.lock:
+      return sorted(xrange(len(self.values)),
+                    key=lambda i: self._value(i, now))
+
+  def record(self, index, latency):
+    now = time.time()
+    with self.lock:
+      value = self._value(index, now)
+      self.values[index] = value + (latency - value) * _latency_weight
+      self.stamps[index] = now
+
+class Mirror(Bridge):
+  """Keep the same objects in each of several Bridges, the volume being
+  named with the given prefix in each.
+  """
+
+  def __init__(self, replicas, prefixes, latencies = None):
+    self.replicas = replicas
+    self.prefixes = prefixes
+    self.access_key = replicas[0].access_key
+    self.bucket = '+'.join(r.bucket for r in replicas)
+    self.volume = replicas[0].volume
+    self._latencies = latencies if latencies \
+      else _Latencies(len(replicas))
+    self.delete_batch_size = replicas[0].delete_batch_size
+    self._can_access = True
+
+  def check_access(self):
+    for replica in self.replicas:
+      replica.check_access()
+
+  def clone(self):
+    return Mirror([r.clone() for r in self.replicas], self.prefixes,
+                  self._latencies)
+
+  def _read(self, read):
+    """Run read on the fastest replica, moving on to the next one if it
+    fails or does not have the object (read returns None or False). A
+    replica which fails is counted as very slow.
+    """
+    error = None
+    missing = None
+    for i in self._latencies.order():
+      start = time.time()
+      try:
+        result = read(self.replicas[i])
+      except Exception as e:
+        self._latencies.record(i, cloudnbd._retry_max_delay)
+        error = error or e
+        continue
+      self._latencies.record(i, time.time() - start)
+      if result is None or result is False:
+        # a write which failed on some of the replicas leaves them
+        # without the object
+        missing = result
+        continue
+      return result
+    if error:
+      raise error
+    return missing
+
+  def _write(self, write):
+    """Run write(replica, prefix) on all the replicas at once, raising
+    the first error once all of them are done.
+    """
+    errors = []
+    def run(replica, prefix):
+      try:
+        write(replica, prefix)
+      except Exception as e:
+        errors.append(e)
+    targets = zip(self.replicas, self.prefixes)
+    threads = []
+    for target in targets[1:]:
+      t = threading.Thread(target=run, args=target)
+      t.daemon = True
+      threads.append(t)
+      t.start()
+    run(*targets[0])
+    for t in threads:
+      t.join()
+    if errors:
+      raise errors[0]
+
+  def get(self, path):
+    def read(replica):
+      # the content is downloaded here so a failure to do so may still
+      # fall back to another replica
+      obj = replica.get(path)
+      if obj is None:
+        return None
+      return obj.metadata, obj.get_content()
+    found = self._read(read)
+    if found is None:
+      return None
+    return MirroredObject(parent=self, nativeobj=(
+      '%s/%s' % (self.volume, path),) + found)
+
+  def get_range(self, path, offset, length):
+    return self._read(lambda r: r.get_range(path, offset, length))
+
+  def exists(self, path):
+    return self._read(lambda r: r.exists(path))
+
+  def set(self, path, content, metadata={}):
+    self._write(lambda r, p: r.set(path, content, metadata=metadata))
+
+  def copy(self, src, target, volume = None):
+    self._write(lambda r, p: r.copy(src, target, volume and p + volume))
+
+  def delete(self, path):
+    self._write(lambda r, p: r.delete(path))
+
+  def delete_many(self, paths):
+    paths = list(paths)
+    self._write(lambda r, p: r.delete_many(paths))
+
+  def list(self, prefix='', marker = None):
+    """List the objects of all the replicas, merged in path order, so
+    that an object which a failed write left on only some of them is
+    still listed. An object on several replicas is listed once.
+    """
+    def named(index, replica):
+      start = len(replica.volume) + 1
+      for k in replica.list(prefix, marker):
+        path = k.name[start:]
+        yield path, index, _ListedObject('%s/%s' % (self.volume, path), k)
+    last = None
+    for path, index, k in heapq.merge(
+        *[named(i, r) for i, r in enumerate(self.replicas)]):
+      if path != last:
+        last = path
+        yield k
+
+  def flush(self):
+    for replica in self.replicas:
+      replica.flush()
+
+class MirroredObject(CloudObject):
+  """A cloud object with content and metadata, the content having been
+  downloaded from one of the replicas of a mirror.
+  """
+
+  def __init__(self, parent, nativeobj):
+    self._nativeobj = nativeobj
+    self._parent = parent
+    self.name, self.metadata, self._content = nativeobj
+
+  def get_content(self):
+    """Return the content of the this object."""
+    return self._content
+
+class Stripe(Bridge):
+  """Spread the objects of a volume over several Bridges."""
+
+  def __init__(self, access_key = None, bucket = None, volume = None):
+    self.access_key = access_key
+    self.bucket = bucket
+    self.volume = volume
+    self._can_access = False
+
+  def check_access(self):
+    """Determine whether this instance with the given credentials is
+    able to access all the members.
+    """
+    backend, sep, access_key = (self.access_key or '').partition(':')
+    backends = cloudnbd.cloud.backends
+    if not sep or backend not in backends or backend == 'stripe':
+      raise BridgeAccessDenied('access key must be in the form'
+                               ' <backend>:<access key>')
+    self._prefixes = []
+    members = []
+    for mirror in parse_members(self.bucket):
+      replicas = []
+      for name, prefix in mirror:
+        replica = backends[backend](access_key=access_key, bucket=name,
+                                    volume=prefix + self.volume)
+        replica.pool_size = self.pool_size
+        replica.check_access()
+        replicas.append(replica)
+      prefixes = [prefix for name, prefix in mirror]
+      if len(replicas) > 1:
+        members.append(Mirror(replicas, prefixes))
+      else:
+        members.append(replicas[0])
+      self._prefixes.append(prefixes[0])
+    self._members = members
+    self.delete_batch_size = members[0].delete_batch_size
+    self._targets = {}
+    self._can_access = True
+
+  def clone(self):
+    new_stripe = Stripe(self.access_key, self.bucket, self.volume)
+    new_stripe._can_access = self._can_access
+    if new_stripe._can_access:
+      new_stripe._prefixes = self._prefixes
+      new_stripe.delete_batch_size = self.delete_batch_size
+      new_stripe._members = [m.clone() for m in self._members]
+      new_stripe._targets = {}
+    return new_stripe
+
+  def _member(self, path):
+    self._ensure_access()
+    return self._members[member_index(path, len(self._members))]
+
+  def get(self, path):
+    return self._member(path).get(path)
+
+  def get_range(self, path, offset, length):
+    return self._member(path).get_range(path, offset, length)
+
+  def exists(self, path):
+    return self._member(path).exists(path)
+
+  def set(self, path, content, metadata={}):
+    self._member(path).set(path, content, metadata=metadata)
+
+  def copy(self, src, target, volume = None):
+    self._ensure_access()
+    count = len(self._members)
+    index = member_index(src, count)
+    if index == member_index(target, count):
+      member = self._members[index]
+      if not isinstance(member, Mirror) and volume:
+        volume = self._prefixes[index] + volume
+      return member.copy(src, target, volume)
+    # the target lives on another member, so the object goes through
+    obj = self.get(src)
+    if obj is None:
+      return
+    other = self
+    if volume:
+      other = self._target(volume)
+    other.set(target, obj.get_content(), metadata=obj.metadata)
+
+  def _target(self, volume):
+    """Return the stripe of another volume over the same members, built
+    and checked once for all the copies into it.
+    """
+    if volume not in self._targets:
+      target = Stripe(self.access_key, self.bucket, volume)
+      target.pool_size = self.pool_size
+      target.check_access()
+      self._targets[volume] = target
+    return self._targets[volume]
+
+  def delete(self, path):
+    self._member(path).delete(path)
+
+  def delete_many(self, paths):
+    self._ensure_access()
+    count = len(self._members)
+    groups = {}
+    for path in paths:
+      groups.setdefault(member_index(path, count), []).append(path)
+    for index, group in groups.items():
+      self._members[index].delete_many(group)
+
+  def list(self, prefix='', marker = None):
+    """List the objects of all the members, merged in path order."""
+    self._ensure_access()
+    def named(member):
+      start = len(member.volume) + 1
+      for k in member.list(prefix, marker):
+        path = k.name[start:]
+        yield path, _ListedObject('%s/%s' % (self.volume, path), k)
+    for path, k in heapq.merge(*[named(m) for m in self._members]):
+      yield k
+
+  def flush(self):
+    self._ensure_access()
+    for member in self._members:
+      member.flush()
+
+  def _ensure_access(self):
+    if not self._can_access:
+      raise BridgeAccessNotChecked(
+        'check_access() must be called first'
+      )
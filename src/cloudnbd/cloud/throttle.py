@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#
+# throttle.py - Bandwidth and request rate limits on the cloud
+# Copyright (C) 2011  Mansour <mansour@oxplot.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Throttling
+
+Uploads and downloads are each limited in bytes and requests per second
+by token buckets shared by all the clones of a ThrottledBridge, so the
+limits hold however many threads use the cloud. Requests which change
+the cloud (set, copy and delete) count as uploads and the rest as
+downloads. A rate of 0 means no limit, and limits may be changed while
+requests are in flight.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import cloudnbd
+import threading
+import time
+from cloudnbd.cloud import *
+
+# names of the limits, the bandwidths being in bytes per second and the
+# request rates in requests per second
+limit_names = ('upload-limit', 'upload-reqs',
+               'download-limit', 'download-reqs')
+
+class TokenBucket(object):
+  """Rate limit shared by threads. Tokens accumulate at the rate up to
+  a burst worth _throttle_burst seconds of it, and taking more tokens
+  than there are blocks until the debt is paid off at the rate.
+  """
+
+  def __init__(self, rate = 0):
+    self._lock = threading.Lock()
+    self.set_rate(rate)
+
+  def set_rate(self, rate):
+    with self._lock:
+      self.rate = rate
+      self._tokens = rate * cloudnbd._throttle_burst
+      self._stamp = time.time()
+
+  def take(self, count):
+    with self._lock:
+      if not self.rate:
+        return
+      now = time.time()
+      self._tokens = min(self.rate * cloudnbd._throttle_burst,
+                         self._tokens + (now - self._stamp) * self.rate)
+      self._stamp = now
+      self._tokens -= count
+      wait = -self._tokens / self.rate
+    if wait > 0:
+      time.sleep(wait)
+
+class ThrottledObject(CloudObject):
+  """A cloud object with content and metadata, the content having been
+  downloaded so its size could be counted.
+  """
+
+  def __init__(self, parent, nativeobj):
+    self._nativeobj = nativeobj
+    self._parent = parent
+    self.name, self.metadata, self._content = nativeobj
+
+  def get_content(self):
+    """Return the content of the this object."""
+    return self._content
+
+class ThrottledBridge(Bridge):
+  """Limit the bandwidth and request rate of another Bridge."""
+
+  def __init__(self, cloud, limits = None, buckets = None):
+    self.cloud = cloud
+    self.access_key = cloud.access_key
+    self.bucket = cloud.bucket
+    self.volume = cloud.volume
+    if buckets is None:
+      buckets = dict((name, TokenBucket()) for name in limit_names)
+    self._buckets = buckets
+    for name, rate in (limits or {}).items():
+      self.set_limit(name, rate)
+    self._can_access = True
+
+  def check_access(self):
+    self.cloud.check_access()
+
+  def clone(self):
+    return ThrottledBridge(self.cloud.clone(), buckets=self._buckets)
+
+  def set_limit(self, name, rate):
+    """Change the limit of the given name for all the clones."""
+    if name not in self._buckets:
+      raise BridgeError("no limit named '%s'" % name)
+    if rate < 0:
+      raise BridgeError("limit '%s' must not be negative" % name)
+    self._buckets[name].set_rate(rate)
+
+  def get_limits(self):
+    return dict((name, bucket.rate)
+                for name, bucket in self._buckets.items())
+
+  def _upload(self, size = 0, requests = 1):
+    self._buckets['upload-reqs'].take(requests)
+    if size:
+      self._buckets['upload-limit'].take(size)
+
+  def _download(self, size = 0):
+    self._buckets['download-reqs'].take(1)
+    if size:
+      self._buckets['download-limit'].take(size)
+
+  def get(self, path):
+    self._download()
+    obj = self.cloud.get(path)
+    if obj is None:
+      return None
+    # the size is only known once it is downloaded, so the bandwidth
+    # taken is paid for by this and the following downloads
+    content = obj.get_content()
+    self._buckets['download-limit'].take(len(content))
+    return ThrottledObject(parent=self, nativeobj=(
+      '%s/%s' % (self.volume, path), obj.metadata, content))
+
+  def get_range(self, path, offset, length):
+    self._download(length)
+    return self.cloud.get_range(path, offset, length)
+
+  def exists(self, path):
+    self._download()
+    return self.cloud.exists(path)
+
+  def set(self, path, content, metadata={}):
+    self._upload(len(content))
+    return self.cloud.set(path, content, metadata=metadata)
+
+  def copy(self, src, target, volume = None):
+    self._upload()
+    return self.cloud.copy(src, target, volume)
+
+  def delete(self, path):
+    self._upload()
+    return self.cloud.delete(path)
+
+  def delete_many(self, paths):
+    # paid for by the number of requests the cloud sends for the batch
+    paths = list(paths)
+    batch = self.cloud.delete_batch_size
+    self._upload(requests=-(-len(paths) // batch) if batch else 1)
+    return self.cloud.delete_many(paths)
+
+  def list(self, prefix='', marker = None):
+    self._download()
+    return self.cloud.list(prefix, marker)
+
+  def flush(self):
+    self.cloud.flush()
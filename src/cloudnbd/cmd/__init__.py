@@ -23,6 +23,14 @@ from __future__ import division
 import cloudnbd
 import sys
 import getpass
+import signal
+
+# signals sent to the server of a volume to close it, by COW action
+close_signals = {
+  None: signal.SIGINT,
+  'apply': signal.SIGUSR1,
+  'discard': signal.SIGUSR2
+}
 
 def fatal(msg):
   sys.stderr.write("%s:error: %s\n" % (cloudnbd._prog_name, msg))
@@ -48,5 +56,11 @@ from cloudnbd.cmd import closeallcmd
 from cloudnbd.cmd import opencmd
 from cloudnbd.cmd import listcmd
 from cloudnbd.cmd import statcmd
+from cloudnbd.cmd import limitcmd
 from cloudnbd.cmd import infocmd
 from cloudnbd.cmd import resizecmd
+from cloudnbd.cmd import rebscmd
+from cloudnbd.cmd import clonecmd
+from cloudnbd.cmd import snapshotcmd
+from cloudnbd.cmd import checkpointcmd
+from cloudnbd.cmd import exportcmd
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# checkpointcmd.py - Create and delete changed block checkpoints
+# Copyright (C) 2011  Mansour <mansour@oxplot.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import cloudnbd
+import os
+from cloudnbd.cmd import fatal, warning, info, get_all_creds
+
+class CheckpointCMD(object):
+  def __init__(self, args):
+    self.args = args
+    self.cloud = cloudnbd.cloud.backends[args.backend](
+      access_key=args.access_key,
+      bucket=args.bucket,
+      volume=args.volume
+    )
+
+  def run(self):
+
+    # check our access to Bridge
+
+    try:
+      self.cloud.check_access()
+    except (cloudnbd.cloud.BridgeAccessDenied,
+            cloudnbd.cloud.BridgeNoSuchBucket) as e:
+      fatal(e.args[0])
+
+    # an open volume only picks up checkpoints when opened
+
+    if os.path.exists(cloudnbd.get_pid_path(
+        self.args.backend, self.args.bucket, self.args.volume)):
+      fatal("volume '%s' is open, close it first" % self.args.volume)
+
+    self.pass_key = cloudnbd.auth.get_pass_key(self.args.passphrase)
+    self.blocktree = cloudnbd.blocktree.BlockTree(
+      pass_key=self.pass_key,
+      cloud=self.cloud,
+      threads=0
+    )
+
+    # ensure there is a volume with the given name (config file exists)
+
+    try:
+      config = self.blocktree.get('config')
+      if not config:
+        fatal("volume with name '%s' does not exist in bucket '%s'"
+              % (self.args.volume, self.args.bucket))
+    except cloudnbd.blocktree.BTInvalidKey:
+      fatal("decryption of config failed, most likely wrong"
+            " passphrase supplied")
+
+    self.config = cloudnbd.deserialize(config)
+    if 'deleted' in self.config:
+      fatal('volume set to be deleted')
+    if self.config.get('readonly'):
+      fatal('snapshots are read only')
+    self.blocktree.crypt_key = self.config['crypt_key'].decode('hex')
+
+    checkpoints = self.config.setdefault('checkpoints', [])
+    path = cloudnbd.bitmap.checkpoint_path(self.args.checkpoint)
+
+    if self.args.delete:
+      if self.args.checkpoint not in checkpoints:
+        fatal("no checkpoint named '%s'" % self.args.checkpoint)
+      checkpoints.remove(self.args.checkpoint)
+      self.blocktree.set('config', cloudnbd.serialize(self.config),
+                         direct=True)
+      self.blocktree.set(path, None, direct=True)
+      print("checkpoint '%s' deleted" % self.args.checkpoint)
+      return
+
+    # creating an existing checkpoint starts it over
+
+    self.blocktree.save_bitmap(path, cloudnbd.bitmap.Bitmap())
+    if self.args.checkpoint not in checkpoints:
+      checkpoints.append(self.args.checkpoint)
+      self.blocktree.set('config', cloudnbd.serialize(self.config),
+                         direct=True)
+    print("checkpoint '%s' created" % self.args.checkpoint)
+
+def main(args):
+  get_all_creds(args)
+  checkpointcmd = CheckpointCMD(args)
+  checkpointcmd.run()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+#
+# clonecmd.py - Copy a volume into a new one on the cloud side
+# Copyright (C) 2011  Mansour <mansour@oxplot.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import cloudnbd
+import os
+import sys
+import tempfile
+import threading
+from cloudnbd.cmd import fatal, warning, info, get_all_creds
+
+class CloneCMD(object):
+  """Copy all the objects of a volume into a new volume without them
+  passing through the client. Objects are encrypted with the key of the
+  volume and their path within it, so the copies are valid as they are.
+  """
+
+  def __init__(self, args, read_only = False):
+    self.args = args
+    self.read_only = read_only
+    self.cloud = cloudnbd.cloud.backends[args.backend](
+      access_key=args.access_key,
+      bucket=args.bucket,
+      volume=args.volume
+    )
+    self.dst_cloud = cloudnbd.cloud.backends[args.backend](
+      access_key=args.access_key,
+      bucket=args.bucket,
+      volume=args.new_volume
+    )
+
+  def run(self):
+
+    # check our access to Bridge
+
+    try:
+      self.cloud.check_access()
+      self.dst_cloud.check_access()
+    except (cloudnbd.cloud.BridgeAccessDenied,
+            cloudnbd.cloud.BridgeNoSuchBucket) as e:
+      fatal(e.args[0])
+
+    # the source must not change while being copied
+
+    if os.path.exists(cloudnbd.get_pid_path(
+        self.args.backend, self.args.bucket, self.args.volume)):
+      fatal("volume '%s' is open, close it first" % self.args.volume)
+
+    self.pass_key = cloudnbd.auth.get_pass_key(self.args.passphrase)
+    self.blocktree = cloudnbd.blocktree.BlockTree(
+      pass_key=self.pass_key,
+      cloud=self.cloud,
+      threads=0
+    )
+
+    # ensure there is a volume with the given name (config file exists)
+
+    try:
+      config = self.blocktree.get('config')
+      if not config:
+        fatal("volume with name '%s' does not exist in bucket '%s'"
+              % (self.args.volume, self.args.bucket))
+    except cloudnbd.blocktree.BTInvalidKey:
+      fatal("decryption of config failed, most likely wrong"
+            " passphrase supplied")
+
+    self.config = cloudnbd.deserialize(config)
+    if 'deleted' in self.config:
+      fatal('volume set to be deleted')
+    if 'incomplete' in self.config:
+      fatal('volume is still being created')
+
+    # ensure no volume with the new name exists
+
+    self.dst = cloudnbd.blocktree.BlockTree(
+      pass_key=self.pass_key,
+      cloud=self.dst_cloud,
+      threads=0
+    )
+    try:
+      if self.dst.get('config'):
+        fatal("volume '%s' in bucket '%s' already exists"
+              % (self.args.new_volume, self.args.bucket))
+    except cloudnbd.blocktree.BTInvalidKey:
+      fatal("volume '%s' in bucket '%s' already exists"
+            % (self.args.new_volume, self.args.bucket))
+
+    # the new volume is marked incomplete until all objects are copied
+    # so it can not be opened half way through - uncommitted COW
+    # changes are left out
+
+    self.dst_config = dict(self.config)
+    self.dst_config.pop('readonly', None)
+    pending = self.dst_config.pop('cow', None)
+    if self.read_only:
+      self.dst_config['readonly'] = True
+    self.dst_config['incomplete'] = True
+    self.dst.set('config', cloudnbd.serialize(self.dst_config),
+                 direct=True)
+
+    # store the name of all objects to a file to avoid concurrent
+    # access issues
+
+    self._cachefile = tempfile.TemporaryFile()
+    self._item_count = 0
+    skip = 'layers/%s/' % pending if pending else None
+
+    name_start = len(self.args.volume) + 1
+    for k in self.cloud.list(prefix=''):
+      name = k.name[name_start:]
+      if name == 'config' or (skip and name.startswith(skip)):
+        continue
+      self._cachefile.write('%s\n' % name)
+      if self._item_count % 10 == 0:
+        _print_caching_progress(self._item_count)
+      self._item_count += 1
+    _print_caching_progress(self._item_count)
+    print()
+
+    # start copying the objects
+
+    self._cachefile.seek(0)
+    self._copy_count = 0
+    self._failed = False
+    self._copy_lock = threading.RLock()
+    self._objects_to_copy = self._get_objects_to_copy()
+
+    threads = []
+    for i in xrange(self.args.threads):
+      t = threading.Thread(target=self._copy_worker_factory())
+      t.daemon = True
+      threads.append(t)
+      t.start()
+
+    for t in threads:
+      t.join()
+    print()
+
+    if self._failed:
+      fatal('copying failed, delete %s and try again'
+            % self.args.new_volume)
+
+    del self.dst_config['incomplete']
+    self.dst.set('config', cloudnbd.serialize(self.dst_config),
+                 direct=True)
+    print("volume '%s' is %s of '%s'"
+          % (self.args.new_volume,
+             'a snapshot' if self.read_only else 'a clone',
+             self.args.volume))
+
+  def _get_objects_to_copy(self):
+    for l in self._cachefile:
+      yield l.strip()
+
+  def _copy_worker_factory(self):
+    cloud = self.cloud.clone()
+    def copy_worker():
+      while True:
+        with self._copy_lock:
+          if self._failed:
+            return
+          try:
+            k = self._objects_to_copy.next()
+          except StopIteration:
+            return
+        try:
+          cloud.copy(k, k, self.args.new_volume)
+        except Exception as e:
+          with self._copy_lock:
+            self._failed = True
+          warning('copying %s failed: %s' % (k, e))
+          return
+        with self._copy_lock:
+          self._copy_count += 1
+          _print_copying_progress(self._item_count, self._copy_count)
+    return copy_worker
+
+def _print_caching_progress(item_count):
+  sys.stdout.write(
+    '\x1b[2K\x1b[1Gcaching the list of obj to copy ... %d'
+    % item_count
+  )
+  sys.stdout.flush()
+
+def _print_copying_progress(total, current):
+  sys.stdout.write(
+    '\x1b[2K\x1b[1Gcopying objects ... %d%%'
+    % int(current / total * 100)
+  )
+  sys.stdout.flush()
+
+def main(args):
+  get_all_creds(args)
+  clonecmd = CloneCMD(args)
+  clonecmd.run()
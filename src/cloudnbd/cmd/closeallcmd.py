@@ -30,7 +30,8 @@ def main(args):
   paths = filter(lambda a: a['ext'] == 'pid', cloudnbd.get_stat_paths())
   for p in paths:
     try:
-      pid = os.kill(int(open(p['path'], 'r').read()), signal.SIGINT)
+      pid = os.kill(int(open(p['path'], 'r').read()),
+                    cloudnbd.cmd.close_signals[args.cow])
       print('%s %s %s -> closing'
             % (p['backend'], p['bucket'], p['volume']))
     except:
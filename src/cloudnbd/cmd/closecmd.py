@@ -32,7 +32,7 @@ def main(args):
   )
   try:
     pid = int(open(pid_path, 'r').read())
-    os.kill(pid, signal.SIGINT)
+    os.kill(pid, cloudnbd.cmd.close_signals[args.cow])
   except:
     fatal('the given volume is not open - use \'%s list\' to see'
           ' list of currently open volumes' % cloudnbd._prog_name)
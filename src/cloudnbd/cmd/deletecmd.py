@@ -22,9 +22,9 @@ from __future__ import absolute_import
 from __future__ import division
 import cloudnbd
 import os
-import tempfile
 import sys
 import threading
+import itertools
 from cloudnbd import nbd
 from cloudnbd.cmd import fatal, warning, info, get_all_creds
 
@@ -36,6 +36,7 @@ class DeleteCMD(object):
       bucket=args.bucket,
       volume=args.volume
     )
+    self.cloud.pool_size = args.connections
 
   def run(self):
 
@@ -83,26 +84,14 @@ class DeleteCMD(object):
       self.blocktree.set('config', cloudnbd.serialize(self.config),
                          direct=True)
 
-    # store the block number of all blocks to a file to avoid concurrent
-    # access issues
+    # list the objects in shards concurrently, feeding them to the
+    # delete workers as they arrive
 
-    self._cachefile = tempfile.TemporaryFile()
-    self._item_count = 0
-
-    for k in self.cloud.list(prefix='blocks/'):
-      self._cachefile.write('%s\n' % k.name.split('/')[-1])
-      if self._item_count % 10 == 0:
-        _print_caching_progress(self._item_count)
-      self._item_count += 1
-    _print_caching_progress(self._item_count)
-    print()
-
-    # start deleting the objects
-
-    self._cachefile.seek(0)
     self._delete_count = 0
+    self._failed = False
     self._delete_lock = threading.RLock()
     self._blocks_to_delete = self._get_blocks_to_delete()
+    self._batch_size = cloudnbd._delete_batch_size
 
     threads = []
     for i in xrange(self.args.threads):
@@ -115,6 +104,12 @@ class DeleteCMD(object):
       t.join()
     print()
 
+    # the config stays, marked deleted, until every other object is gone
+    # so the deletion can be run again
+
+    if self._failed:
+      fatal('deleting failed, run delete again to finish it')
+
     # delete the config file
 
     self.cloud.delete('config')
@@ -122,38 +117,45 @@ class DeleteCMD(object):
 
 
   def _get_blocks_to_delete(self):
-    for l in self._cachefile:
-      yield l.strip()
+    name_start = len(self.args.volume) + 1
+    for k in self.cloud.list_sharded(
+        '', cloudnbd.blocktree._list_shard_bounds):
+      if k.name[name_start:] != 'config':
+        yield k.name[name_start:]
 
   def _delete_worker_factory(self):
     cloud = self.cloud.clone()
     def delete_worker():
       while True:
+        with self._delete_lock:
+          if self._failed:
+            return
+          # objects are listed as the batches are taken, so an error
+          # listing them surfaces here and ends the listing for all
+          try:
+            batch = list(itertools.islice(self._blocks_to_delete,
+                                          self._batch_size))
+          except Exception as e:
+            self._failed = True
+            warning('listing objects failed: %s' % e)
+            return
+        if not batch:
+          return
         try:
+          cloud.delete_many(batch)
+        except Exception as e:
           with self._delete_lock:
-            k = self._blocks_to_delete.next()
-          cloud.delete('blocks/%s' % k)
-          with self._delete_lock:
-            self._delete_count += 1
-            if self._delete_count % (self._item_count // 110) == 0:
-              _print_deleting_progress(
-                self._item_count, self._delete_count)
-        except StopIteration:
+            self._failed = True
+          warning('deleting failed: %s' % e)
           return
+        with self._delete_lock:
+          self._delete_count += len(batch)
+          _print_deleting_progress(self._delete_count)
     return delete_worker
 
-
-def _print_caching_progress(item_count):
-  sys.stdout.write(
-    '\x1b[2K\x1b[1Gcaching the list of obj to delete ... %d'
-    % item_count
-  )
-  sys.stdout.flush()
-
-def _print_deleting_progress(total, current):
+def _print_deleting_progress(current):
   sys.stdout.write(
-    '\x1b[2K\x1b[1Gdeleting objects ... %d%%'
-    % int(current / total * 100)
+    '\x1b[2K\x1b[1Gdeleting objects ... %d' % current
   )
   sys.stdout.flush()
 
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+#
+# exportcmd.py - Stream the blocks changed since a checkpoint
+# Copyright (C) 2011  Mansour <mansour@oxplot.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import cloudnbd
+import os
+import sys
+import struct
+import threading
+from cloudnbd.cmd import fatal, warning, info, get_all_creds
+
+# The export starts with the magic followed by the block size and the
+# size of the volume. Each block then follows as its number and kind,
+# and for data blocks, the block itself. The stream ends with a record
+# of kind end.
+
+_magic = b'CBDEXP01'
+_header_fmt = b'!QQ'
+_record_fmt = b'!QB'
+KIND_ZERO = 0
+KIND_DATA = 1
+KIND_END = 2
+
+class ExportCMD(object):
+  def __init__(self, args):
+    self.args = args
+    self.cloud = cloudnbd.cloud.backends[args.backend](
+      access_key=args.access_key,
+      bucket=args.bucket,
+      volume=args.volume
+    )
+
+  def run(self):
+
+    # check our access to Bridge
+
+    try:
+      self.cloud.check_access()
+    except (cloudnbd.cloud.BridgeAccessDenied,
+            cloudnbd.cloud.BridgeNoSuchBucket) as e:
+      fatal(e.args[0])
+
+    # the volume must not change while being exported
+
+    if os.path.exists(cloudnbd.get_pid_path(
+        self.args.backend, self.args.bucket, self.args.volume)):
+      fatal("volume '%s' is open, close it first" % self.args.volume)
+
+    self.pass_key = cloudnbd.auth.get_pass_key(self.args.passphrase)
+    self.blocktree = cloudnbd.blocktree.BlockTree(
+      pass_key=self.pass_key,
+      cloud=self.cloud,
+      threads=0
+    )
+
+    # ensure there is a volume with the given name (config file exists)
+
+    try:
+      config = self.blocktree.get('config')
+      if not config:
+        fatal("volume with name '%s' does not exist in bucket '%s'"
+              % (self.args.volume, self.args.bucket))
+    except cloudnbd.blocktree.BTInvalidKey:
+      fatal("decryption of config failed, most likely wrong"
+            " passphrase supplied")
+
+    self.config = cloudnbd.deserialize(config)
+    if 'deleted' in self.config:
+      fatal('volume set to be deleted')
+    if 'incomplete' in self.config:
+      fatal('volume is still being created')
+    self.blocktree.crypt_key = self.config['crypt_key'].decode('hex')
+    try:
+      self.blocktree.codec = cloudnbd.codec.get_codec(
+        self.config.get('codec', cloudnbd._default_codec))
+    except cloudnbd.codec.CodecError as e:
+      fatal(e.args[0])
+    self.cloud = cloudnbd.cloud.segment.open_layout(self.cloud,
+                                                    self.config)
+    self.blocktree.cloud = self.cloud
+    self.blocktree.open_alloc(read_only=True)
+
+    # uncommitted COW changes are not exported
+
+    layers = self.config.get('layers', [])
+    self.overlay = None
+    if layers:
+      self.overlay = cloudnbd.overlay.Overlay(
+        self.blocktree, layers[:-1], layers[-1])
+      self.overlay.open(read_only=True)
+
+    # pick the blocks to export
+
+    changed = None
+    if self.args.since:
+      if self.args.since not in self.config.get('checkpoints', []):
+        fatal("no checkpoint named '%s'" % self.args.since)
+      changed = self.blocktree.load_bitmap(
+        cloudnbd.bitmap.checkpoint_path(self.args.since))
+      if changed is None:
+        warning("checkpoint '%s' is invalid, exporting all blocks"
+                % self.args.since)
+    if changed is not None:
+      blocks = list(changed)
+    elif self.overlay:
+      blocks = sorted(self.overlay.allocated())
+    else:
+      blocks = list(self.blocktree.alloc)
+
+    # fetch the blocks in parallel, writing them out in order
+
+    out = open(self.args.output, 'wb') if self.args.output \
+      else sys.stdout
+    bs = self.config['bs']
+    out.write(_magic + struct.pack(_header_fmt, bs, self.config['size']))
+    self._lock = threading.RLock()
+    self._ready = threading.Condition(self._lock)
+    self._data = {}
+
+    # the workers fetch up to window blocks ahead of the one being
+    # written out, so the slowest fetch only holds up its own block
+
+    self._blocks = iter(blocks)
+    self._window = self.args.threads * 4
+    self._taken = 0
+    self._written = 0
+    threads = []
+    for j in xrange(self.args.threads):
+      t = threading.Thread(target=self._fetch_worker_factory())
+      t.daemon = True
+      threads.append(t)
+      t.start()
+
+    sent = 0
+    for n, block in enumerate(blocks):
+      with self._ready:
+        while block not in self._data:
+          self._ready.wait()
+        data = self._data.pop(block)
+        self._written += 1
+        self._ready.notify_all()
+      if isinstance(data, Exception):
+        fatal('export failed: %s' % data)
+      if data and data != b'\0' * bs:
+        out.write(struct.pack(_record_fmt, block, KIND_DATA))
+        out.write(data.ljust(bs, b'\0'))
+        sent += 1
+      else:
+        out.write(struct.pack(_record_fmt, block, KIND_ZERO))
+      if (n + 1) % self._window == 0 or n + 1 == len(blocks):
+        _print_exporting_progress(len(blocks), n + 1)
+    for t in threads:
+      t.join()
+    out.write(struct.pack(_record_fmt, 2 ** 64 - 1, KIND_END))
+    out.flush()
+    sys.stderr.write('\n')
+    info('exported %d of %d blocks' % (sent, len(blocks)))
+
+  def _fetch_worker_factory(self):
+    cloud = self.cloud.clone()
+    def fetch_worker():
+      while True:
+        with self._ready:
+          while self._taken - self._written >= self._window:
+            self._ready.wait()
+          try:
+            block = self._blocks.next()
+          except StopIteration:
+            return
+          self._taken += 1
+        try:
+          if self.overlay:
+            data = self.overlay.fetch_block(block, cloud)
+          else:
+            data = self.blocktree.fetch('blocks/%d' % block, cloud)
+        except Exception as e:
+          data = e
+        with self._ready:
+          self._data[block] = data
+          self._ready.notify_all()
+    return fetch_worker
+
+def _print_exporting_progress(total, current):
+  sys.stderr.write(
+    '\x1b[2K\x1b[1Gexporting blocks ... %d%%'
+    % (int(min(current, total) / total * 100) if total else 100)
+  )
+  sys.stderr.flush()
+
+def main(args):
+  get_all_creds(args)
+  exportcmd = ExportCMD(args)
+  exportcmd.run()
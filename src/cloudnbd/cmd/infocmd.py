@@ -77,6 +77,15 @@ class InfoCMD(object):
       % cloudnbd.size_to_hum(self.config['size']))
     print('block size:   %s' \
       % cloudnbd.size_to_hum(self.config['bs']))
+    print('codec:        %s' \
+      % self.config.get('codec', cloudnbd._default_codec))
+    print('dedup:        %s' \
+      % ('on' if self.config.get('dedup') else 'off'))
+    print('layout:       %s' % self.config.get('layout', 'object'))
+    print('layers:       %d' % len(self.config.get('layers', [])))
+    print('cow pending:  %s' % ('yes' if 'cow' in self.config else 'no'))
+    print('checkpoints:  %s'
+          % ' '.join(self.config.get('checkpoints', [])))
 
 def main(args):
   get_all_creds(args)
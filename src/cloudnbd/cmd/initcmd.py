@@ -25,6 +25,11 @@ from cloudnbd.cmd import fatal, warning, info, get_all_creds
 
 def main(args):
 
+  try:
+    codec = cloudnbd.codec.get_codec(args.codec)
+  except cloudnbd.codec.CodecError as e:
+    fatal(e.args[0])
+
   get_all_creds(args)
 
   cloud = cloudnbd.cloud.backends[args.backend](
@@ -64,9 +69,14 @@ def main(args):
   # set up the config
 
   config = cloudnbd.serialize({
-    'bs': cloudnbd._default_bs,
+    'bs': args.block_size,
     'crypt_key': crypt_key.encode('hex'),
+    'codec': unicode(codec),
+    'dedup': args.dedup,
+    'layout': args.layout,
+    'segment_size': args.segment_size,
     'size': args.size
   })
   blocktree.set('config', config, direct=True)
+  blocktree.alloc = cloudnbd.bitmap.Bitmap()
   blocktree.close()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+#
+# limitcmd.py - Change the limits of an open volume
+# Copyright (C) 2011  Mansour <mansour@oxplot.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import cloudnbd
+import os
+import sys
+from cloudnbd.cmd import fatal, warning, info, get_all_creds
+
+def main(args):
+
+  # each limit is sent as a line of its name and value
+
+  lines = []
+  for name in cloudnbd.cloud.throttle.limit_names:
+    value = getattr(args, name.replace('-', '_'))
+    if value is not None:
+      lines.append('%s %d\n' % (name, value))
+  if not lines:
+    fatal('no limits given')
+
+  # writing to the control pipe fails right away unless the volume is
+  # open and reading it
+
+  path = cloudnbd.get_ctl_path(args.backend, args.bucket, args.volume)
+  try:
+    fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+  except OSError:
+    fatal('the requested volume does not seem to be open - use'
+          ' \'%s list\' to get list of currently open volumes'
+          % cloudnbd._prog_name)
+  try:
+    os.write(fd, ''.join(lines).encode('ascii'))
+  finally:
+    os.close(fd)
+  info('limits sent')
@@ -37,12 +37,14 @@ class OpenCMD(object):
   """Serve the cloud through an NBD server"""
   def __init__(self, args):
     self._serve_stat = False
+    self._serve_ctl = False
     self.args = args
     self.cloud = cloudnbd.cloud.backends[args.backend](
       access_key=args.access_key,
       bucket=args.bucket,
       volume=args.volume
     )
+    self.cloud.pool_size = args.connections
     self.nbd = nbd.NBD(
       host=args.bind_address,
       port=args.port,
@@ -51,13 +53,29 @@ class OpenCMD(object):
       closecb=self.nbd_closecb
     )
     self._interrupted = False
+    self._cow_action = None
+    self.overlay = None
+    self.checkpoints = {}
 
   def get_block(self, block):
-    data = self.blocktree.get('blocks/%d' % block)
+    if self.overlay:
+      data = self.overlay.get_block(block)
+    else:
+      data = self.blocktree.get('blocks/%d' % block)
     return data if data else self.empty_block
 
   def set_block(self, block, data):
-    self.blocktree.set('blocks/%d' % block, data)
+    # all zero blocks are deleted rather than uploaded as missing blocks
+    # read back as zeros anyway
+    if data == self.empty_block:
+      data = None
+    if self.overlay:
+      self.overlay.set_block(block, data)
+    else:
+      self.blocktree.set('blocks/%d' % block, data)
+    for changed in self.checkpoints.values():
+      if changed is not None:
+        changed.add(block)
 
   def nbd_readcb(self, off, length):
     bs = self.config['bs']
@@ -139,12 +157,91 @@ class OpenCMD(object):
 
     if 'deleted' in self.config:
       fatal('volume set to be deleted')
+    if 'incomplete' in self.config:
+      fatal('volume is still being created')
 
     # get the encryption key
 
     self.crypt_key = self.config['crypt_key'].decode('hex')
     self.blocktree.crypt_key = self.crypt_key
 
+    # get the compression codec
+
+    try:
+      self.blocktree.codec = cloudnbd.codec.get_codec(
+        self.config.get('codec', cloudnbd._default_codec))
+    except cloudnbd.codec.CodecError as e:
+      fatal(e.args[0])
+    self.blocktree.dedup = self.config.get('dedup', False)
+
+    # limit the bandwidth and request rate, the limits being adjustable
+    # through the control pipe while the volume is open
+
+    limits = {}
+    for name in cloudnbd.cloud.throttle.limit_names:
+      value = getattr(self.args, name.replace('-', '_'))
+      if value is not None:
+        limits[name] = value
+    self.cloud = self._throttled = \
+      cloudnbd.cloud.throttle.ThrottledBridge(self.cloud, limits)
+
+    # hedge the reads which take unusually long
+
+    self._hedged = None
+    if self.args.hedge:
+      self.cloud = self._hedged = cloudnbd.cloud.hedge.HedgedBridge(
+        self.cloud, self.args.hedge)
+
+    # access the blocks according to the layout of the volume
+
+    self.cloud = cloudnbd.cloud.segment.open_layout(self.cloud,
+                                                    self.config)
+    self.blocktree.cloud = self.cloud
+
+    # snapshots are served read only and are never modified
+
+    read_only = bool(self.config.get('readonly'))
+    if read_only and self.args.cow:
+      fatal('snapshots are read only and can not be COWed')
+    self.nbd.read_only = read_only
+
+    # load the bitmap of allocated blocks
+
+    if self.blocktree.open_alloc(read_only=read_only):
+      info('volume was not closed cleanly, allocation bitmap rebuilt')
+
+    # with COW, all writes go to an uncommitted layer on top of the
+    # committed ones - otherwise they go to the newest committed layer
+
+    layers = self.config.get('layers', [])
+    if self.args.cow:
+      if 'cow' not in self.config:
+        self.config['cow'] = cloudnbd.overlay.new_layer_id()
+        self.save_config()
+      self.overlay = cloudnbd.overlay.Overlay(
+        self.blocktree, layers, self.config['cow'])
+    elif 'cow' in self.config:
+      fatal('volume has uncommitted COW changes - open it with --cow'
+            ' and close it with --cow apply or --cow discard')
+    elif layers:
+      self.overlay = cloudnbd.overlay.Overlay(
+        self.blocktree, layers[:-1], layers[-1])
+    if self.overlay:
+      self.overlay.open(read_only=read_only)
+
+    # track the blocks changed since each checkpoint - a checkpoint
+    # whose bitmap was not saved cleanly can no longer be relied on
+
+    for name in self.config.get('checkpoints', []):
+      path = cloudnbd.bitmap.checkpoint_path(name)
+      changed = self.blocktree.load_bitmap(path)
+      if changed is None:
+        warning("checkpoint '%s' is invalid as the volume was not"
+                " closed cleanly" % name)
+      if not read_only:
+        self.blocktree.save_bitmap(path, None)
+      self.checkpoints[name] = changed
+
     # set cache sizes
 
     total_cache = self.args.max_cache // self.config['bs']
@@ -184,24 +281,33 @@ class OpenCMD(object):
       self.args.backend, self.args.bucket, self.args.volume)
     self._pid_path = cloudnbd.get_pid_path(
       self.args.backend, self.args.bucket, self.args.volume)
+    self._ctl_path = cloudnbd.get_ctl_path(
+      self.args.backend, self.args.bucket, self.args.volume)
 
     def create_stat():
       if os.path.exists(self._stat_path):
         os.unlink(self._stat_path)
       os.mknod(self._stat_path, 0644 | stat.S_IFIFO)
       self._serve_stat = True
+    def create_ctl():
+      if os.path.exists(self._ctl_path):
+        os.unlink(self._ctl_path)
+      os.mknod(self._ctl_path, 0600 | stat.S_IFIFO)
+      self._serve_ctl = True
     def create_pid():
       open(self._pid_path, 'w').write(str(os.getpid()))
     def delete_file(path):
       os.unlink(path)
     create_stat()
     self._run_silent(create_stat)
+    self._run_silent(create_ctl)
     self._run_silent(create_pid)
 
     try:
       self._run()
     finally:
       self._run_silent(delete_file, self._stat_path)
+      self._run_silent(delete_file, self._ctl_path)
       self._run_silent(delete_file, self._pid_path)
 
   def _stat_server_worker(self):
@@ -221,11 +327,35 @@ class OpenCMD(object):
         )
         stats['cache-limit'] = cloudnbd.size_to_hum(self.args.max_cache)
         stats['sent-reqs'] = str(rstats['sent_count'])
+        stats['zero-deletes'] = str(rstats['delete_count'])
+        stats['unchanged-skips'] = str(rstats['unchanged_count'])
+        stats['absent-hits'] = str(rstats['absent_hits'])
+        stats['write-errors'] = str(rstats['write_errors'])
+        retry_stats = cloudnbd.cloud.get_retry_stats()
+        stats['cloud-retries'] = str(retry_stats['retries'])
+        stats['cloud-giveups'] = str(retry_stats['gave_up'])
         stats['recv-reqs'] = str(rstats['recv_count'])
+        for name, rate in self._throttled.get_limits().items():
+          if rate:
+            stats[name] = '%s/s' % (cloudnbd.size_to_hum(rate)
+              if name.endswith('-limit') else rate)
+        if self._hedged:
+          hedge_stats = self._hedged.get_stats()
+          stats['hedged-reqs'] = str(hedge_stats['hedges'])
+          stats['hedge-wins'] = str(hedge_stats['hedge_wins'])
         stats['sent-data'] = cloudnbd.size_to_hum(rstats['data_sent'])
         stats['recv-data'] = cloudnbd.size_to_hum(rstats['data_recv'])
         stats['sent-actual'] = cloudnbd.size_to_hum(rstats['wire_sent'])
         stats['recv-actual'] = cloudnbd.size_to_hum(rstats['wire_recv'])
+        compress_total = rstats['compressed'] \
+          + rstats['compress_skipped'] + rstats['compress_wasted']
+        if compress_total:
+          stats['compress-skipped'] = '%.1f%%' \
+            % (rstats['compress_skipped'] / compress_total * 100)
+          stats['compress-wasted'] = '%.1f%%' \
+            % (rstats['compress_wasted'] / compress_total * 100)
+        if self.blocktree.dedup:
+          stats['dedup-hits'] = str(rstats['dedup_hits'])
         stats['status'] = self._status
         stats['socket'] = '%s:%d' % (self.args.bind_address,
                                      self.args.port)
@@ -240,21 +370,47 @@ class OpenCMD(object):
         pass
       time.sleep(0.5)
 
+  def _ctl_server_worker(self):
+    while True:
+      try:
+        f = open(self._ctl_path, 'r')
+        for line in f:
+          name, _, value = line.strip().partition(' ')
+          try:
+            self._throttled.set_limit(name, int(value))
+          except (cloudnbd.cloud.BridgeError, ValueError):
+            pass
+        f.close()
+      except:
+        time.sleep(0.5)
+
   def _run(self):
 
       # start a thread for stat
 
       self._status = 'open'
 
+      # fork the encode/decode workers before any other thread exists
+
+      self.blocktree.start_codec_procs(self.args.procs,
+                                       self.config['bs'])
+
       if self._serve_stat:
         self._stat_thread = \
           threading.Thread(target=self._stat_server_worker)
         self._stat_thread.daemon = True
         self._stat_thread.start()
+      if self._serve_ctl:
+        self._ctl_thread = \
+          threading.Thread(target=self._ctl_server_worker)
+        self._ctl_thread.daemon = True
+        self._ctl_thread.start()
 
       # start the readers/writers workers on blocktree
 
       self.blocktree.start_writers()
+      if isinstance(self.cloud, cloudnbd.cloud.segment.SegmentBridge):
+        self.cloud.start_maintenance()
       # self.blocktree.start_readers()
 
       # start NBD server
@@ -265,6 +421,10 @@ class OpenCMD(object):
 
         signal.signal(signal.SIGTERM, self.sigterm_handler)
         signal.signal(signal.SIGINT, self.sigint_handler)
+        signal.signal(cloudnbd.cmd.close_signals['apply'],
+                      self.sigcow_handler)
+        signal.signal(cloudnbd.cmd.close_signals['discard'],
+                      self.sigcow_handler)
 
         if self.args.foreground:
           print('running server')
@@ -286,6 +446,31 @@ class OpenCMD(object):
       if self.args.foreground:
         print('committing cache before closing')
       self.blocktree.close()
+      if self.overlay and not self.nbd.read_only:
+        self.overlay.save()
+      if not self.nbd.read_only:
+        for name, changed in self.checkpoints.items():
+          if changed is not None:
+            self.blocktree.save_bitmap(
+              cloudnbd.bitmap.checkpoint_path(name), changed)
+
+      if self.args.cow and self._cow_action == 'apply':
+        self.config.setdefault('layers', []).append(self.config['cow'])
+        del self.config['cow']
+        self.save_config()
+        if self.args.foreground:
+          print('COW changes applied')
+      elif self.args.cow and self._cow_action == 'discard':
+        del self.config['cow']
+        self.save_config()
+        self.overlay.top.drop(self.cloud)
+        self.cloud.flush()
+        if self.args.foreground:
+          print('COW changes discarded')
+
+  def save_config(self):
+    self.blocktree.set('config', cloudnbd.serialize(self.config),
+                       direct=True)
 
   def sig_noop_handler(self, signum, frame):
     pass
@@ -297,6 +482,12 @@ class OpenCMD(object):
     self.nbd.interrupted = True
     signal.signal(signal.SIGINT, self.sig_noop_handler)
 
+  def sigcow_handler(self, signum, frame):
+    for action, sig in cloudnbd.cmd.close_signals.items():
+      if sig == signum:
+        self._cow_action = action
+    self.sigint_handler(signum, frame)
+
 def main(args):
 
   # ensure the volume is not already open
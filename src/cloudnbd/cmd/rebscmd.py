@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+#
+# rebscmd.py - Copy a volume into a new one with a different block size
+# Copyright (C) 2011  Mansour <mansour@oxplot.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import cloudnbd
+import os
+import sys
+import threading
+import fractions
+from cloudnbd.cmd import fatal, warning, info, get_all_creds
+
+class RebsCMD(object):
+  def __init__(self, args):
+    self.args = args
+    self.src_cloud = cloudnbd.cloud.backends[args.backend](
+      access_key=args.access_key,
+      bucket=args.bucket,
+      volume=args.volume
+    )
+    self.dst_cloud = cloudnbd.cloud.backends[args.backend](
+      access_key=args.access_key,
+      bucket=args.bucket,
+      volume=args.new_volume
+    )
+
+  def run(self):
+
+    # check our access to Bridge
+
+    try:
+      self.src_cloud.check_access()
+      self.dst_cloud.check_access()
+    except (cloudnbd.cloud.BridgeAccessDenied,
+            cloudnbd.cloud.BridgeNoSuchBucket) as e:
+      fatal(e.args[0])
+
+    # the source must not change while being copied
+
+    if os.path.exists(cloudnbd.get_pid_path(
+        self.args.backend, self.args.bucket, self.args.volume)):
+      fatal("volume '%s' is open, close it first" % self.args.volume)
+
+    self.pass_key = cloudnbd.auth.get_pass_key(self.args.passphrase)
+    self.src = cloudnbd.blocktree.BlockTree(
+      pass_key=self.pass_key,
+      cloud=self.src_cloud,
+      threads=0
+    )
+
+    # ensure there is a volume with the given name (config file exists)
+
+    try:
+      config = self.src.get('config')
+      if not config:
+        fatal("volume with name '%s' does not exist in bucket '%s'"
+              % (self.args.volume, self.args.bucket))
+    except cloudnbd.blocktree.BTInvalidKey:
+      fatal("decryption of config failed, most likely wrong"
+            " passphrase supplied")
+
+    self.src_config = cloudnbd.deserialize(config)
+    if 'deleted' in self.src_config:
+      fatal('volume set to be deleted')
+    if 'incomplete' in self.src_config:
+      fatal('volume is still being created')
+    if self.src_config.get('layers') or 'cow' in self.src_config:
+      fatal('volumes with COW layers can not be copied')
+    self.src.crypt_key = self.src_config['crypt_key'].decode('hex')
+    try:
+      self.src.codec = cloudnbd.codec.get_codec(
+        self.src_config.get('codec', cloudnbd._default_codec))
+    except cloudnbd.codec.CodecError as e:
+      fatal(e.args[0])
+
+    # ensure no volume with the new name exists
+
+    crypt_key = cloudnbd.auth.gen_crypt_key()
+    self.dst = cloudnbd.blocktree.BlockTree(
+      pass_key=self.pass_key,
+      crypt_key=crypt_key,
+      cloud=self.dst_cloud,
+      threads=self.args.threads,
+      codec=self.src.codec,
+      dedup=self.src_config.get('dedup', False)
+    )
+    try:
+      if self.dst.get('config'):
+        fatal("volume '%s' in bucket '%s' already exists"
+              % (self.args.new_volume, self.args.bucket))
+    except cloudnbd.blocktree.BTInvalidKey:
+      fatal("volume '%s' in bucket '%s' already exists"
+            % (self.args.new_volume, self.args.bucket))
+
+    # the new volume is marked incomplete until all blocks are copied
+    # so it can not be opened half way through - it is writable and
+    # starts with no checkpoints as their bitmaps are not copied
+
+    self.dst_config = dict(self.src_config)
+    self.dst_config.pop('checkpoints', None)
+    self.dst_config.pop('readonly', None)
+    self.dst_config['bs'] = self.args.block_size
+    self.dst_config['crypt_key'] = crypt_key.encode('hex')
+    self.dst_config['incomplete'] = True
+    self.dst.set('config', cloudnbd.serialize(self.dst_config),
+                 direct=True)
+
+    self.src_cloud = cloudnbd.cloud.segment.open_layout(
+      self.src_cloud, self.src_config)
+    self.src.cloud = self.src_cloud
+    self.dst.cloud = cloudnbd.cloud.segment.open_layout(
+      self.dst_cloud, self.dst_config)
+
+    # the data is copied in units which are whole multiples of both
+    # block sizes, so every unit maps to its own set of source and
+    # target blocks
+
+    self._src_bs = self.src_config['bs']
+    self._dst_bs = self.args.block_size
+    self._unit = self._src_bs * self._dst_bs \
+      // fractions.gcd(self._src_bs, self._dst_bs)
+    print('copying %s in blocks of %d to %s in blocks of %d'
+          % (self.args.volume, self._src_bs,
+             self.args.new_volume, self._dst_bs))
+
+    units = set()
+    for k in self.src_cloud.list(prefix='blocks/'):
+      block_num = int(k.name.split('/')[-1])
+      units.add(block_num * self._src_bs // self._unit)
+    self._units = iter(sorted(units))
+    self._unit_count = len(units)
+    self._done_count = 0
+    self._failed = False
+    self._lock = threading.RLock()
+
+    self.dst.set_cache_limits(
+      total=self.args.threads * 2,
+      write=self.args.threads * 2,
+      flush=1
+    )
+    self.dst.alloc = cloudnbd.bitmap.Bitmap()
+    self.dst.start_writers()
+
+    threads = []
+    _print_copying_progress(self._unit_count, 0)
+    for i in xrange(self.args.threads):
+      t = threading.Thread(target=self._copy_worker_factory())
+      t.daemon = True
+      threads.append(t)
+      t.start()
+    for t in threads:
+      t.join()
+    self.dst.close()
+    print()
+
+    if self._failed:
+      fatal('copying failed, delete %s and try again'
+            % self.args.new_volume)
+
+    del self.dst_config['incomplete']
+    self.dst.set('config', cloudnbd.serialize(self.dst_config),
+                 direct=True)
+    print('%s is ready to be opened' % self.args.new_volume)
+
+  def _copy_worker_factory(self):
+    cloud = self.src_cloud.clone()
+    def copy_worker():
+      while True:
+        with self._lock:
+          if self._failed:
+            return
+          try:
+            unit = self._units.next()
+          except StopIteration:
+            return
+        try:
+          self._copy_unit(cloud, unit)
+        except Exception as e:
+          with self._lock:
+            self._failed = True
+          warning('copying failed: %s' % e)
+          return
+        with self._lock:
+          self._done_count += 1
+          _print_copying_progress(self._unit_count, self._done_count)
+    return copy_worker
+
+  def _copy_unit(self, cloud, unit):
+    """Read the source blocks of a unit and queue the target blocks
+    which are not all zeros for uploading.
+    """
+    start = unit * self._unit
+    data = []
+    for b in xrange(start // self._src_bs,
+                    (start + self._unit) // self._src_bs):
+      block = self.src.fetch('blocks/%d' % b, cloud)
+      data.append(block if block else b'\0' * self._src_bs)
+    data = b''.join(data)
+    empty_block = b'\0' * self._dst_bs
+    first = start // self._dst_bs
+    for i in xrange(self._unit // self._dst_bs):
+      block = data[i * self._dst_bs:(i + 1) * self._dst_bs]
+      if block != empty_block:
+        self.dst.set('blocks/%d' % (first + i), block)
+
+def _print_copying_progress(total, current):
+  sys.stdout.write(
+    '\x1b[2K\x1b[1Gcopying blocks ... %d%%'
+    % (int(current / total * 100) if total else 100)
+  )
+  sys.stdout.flush()
+
+def main(args):
+  get_all_creds(args)
+  rebscmd = RebsCMD(args)
+  rebscmd.run()
@@ -22,9 +22,9 @@ from __future__ import absolute_import
 from __future__ import division
 import cloudnbd
 import os
-import tempfile
 import sys
 import threading
+import itertools
 from cloudnbd import nbd
 from cloudnbd.cmd import fatal, warning, info, get_all_creds
 
@@ -36,6 +36,7 @@ class ResizeCMD(object):
       bucket=args.bucket,
       volume=args.volume
     )
+    self.cloud.pool_size = args.connections
 
   def run(self):
 
@@ -99,31 +100,39 @@ class ResizeCMD(object):
       print('resize completed with no cleanup')
       return
 
-    # store the block number of all blocks to a file to avoid concurrent
-    # access issues
-
-    self._cachefile = tempfile.TemporaryFile()
-    self._item_count = 0
-    last_block = (self.config['size'] // self.config['bs']) + 1
-
-    _print_caching_progress(self._item_count)
-    for k in self.cloud.list(prefix='blocks/'):
-      block_num = int(k.name.split('/')[-1])
-      if block_num > last_block:
-        self._cachefile.write('%s\n' % k.name.split('/')[-1])
-        if self._item_count % 10 == 0:
-          _print_caching_progress(self._item_count)
-        self._item_count += 1
-    _print_caching_progress(self._item_count)
-    print()
+    self.cloud = cloudnbd.cloud.segment.open_layout(self.cloud,
+                                                    self.config)
+    self.blocktree.cloud = self.cloud
+    self.blocktree.crypt_key = self.config['crypt_key'].decode('hex')
+    try:
+      self.blocktree.codec = cloudnbd.codec.get_codec(
+        self.config.get('codec', cloudnbd._default_codec))
+    except cloudnbd.codec.CodecError as e:
+      fatal(e.args[0])
+    self.blocktree.open_alloc()
+
+    # the blocks beyond the end are found in the allocation bitmap, which
+    # iterates over a snapshot of itself so they can be fed straight to
+    # the delete workers
+
+    self._last_block = (self.config['size'] // self.config['bs']) + 1
+    self._item_count = sum(1 for block_num in self.blocktree.alloc
+                           if block_num > self._last_block)
 
     # start deleting the objects
 
-    self._cachefile.seek(0)
     self._delete_count = 0
     self._delete_lock = threading.RLock()
     self._blocks_to_delete = self._get_blocks_to_delete()
 
+    # each worker deletes a batch of objects at a time, the batches
+    # being small enough to keep all the workers busy
+
+    self._batch_size = max(1, min(
+      cloudnbd._delete_batch_size,
+      -(-self._item_count // self.args.threads)
+    ))
+
     threads = []
     for i in xrange(self.args.threads):
       t = threading.Thread(target=self._delete_worker_factory())
@@ -134,37 +143,106 @@ class ResizeCMD(object):
     for t in threads:
       t.join()
     print()
+
+    # deduplicated content is shared between blocks, so it is only
+    # deleted once no block refers to it any more
+
+    if self.config.get('dedup'):
+      self._sweep_content()
+
+    self.cloud.flush()
+    self.blocktree.save_alloc()
     print('object cleanup completed')
     print('resize completed with object cleanup')
 
   def _get_blocks_to_delete(self):
-    for l in self._cachefile:
-      yield l.strip()
+    for block_num in self.blocktree.alloc:
+      if block_num > self._last_block:
+        yield 'blocks/%d' % block_num
 
-  def _delete_worker_factory(self):
+  def _sweep_content(self):
+
+    # list the blocks, including those of layers, and the content
+
+    name_start = len(self.args.volume) + 1
+    block_paths = []
+    self._unreferenced = set()
+    for k in self.cloud.list_sharded(
+        '', cloudnbd.blocktree._list_shard_bounds):
+      path = k.name[name_start:]
+      if path.startswith('data/'):
+        self._unreferenced.add(path)
+      elif cloudnbd.blocktree._block_pat.match(path):
+        block_paths.append(path)
+
+    # unmark the content referred to by any block
+
+    self._blocks_to_mark = iter(block_paths)
+    self._mark_failed = False
+    threads = []
+    for i in xrange(self.args.threads):
+      t = threading.Thread(target=self._mark_worker_factory())
+      t.daemon = True
+      threads.append(t)
+      t.start()
+    for t in threads:
+      t.join()
+    if self._mark_failed:
+      warning('some blocks could not be read - unreferenced content'
+              ' is left in place')
+      return
+
+    # delete the rest
+
+    self._blocks_to_delete = iter(sorted(self._unreferenced))
+    self._item_count = len(self._unreferenced)
+    self._delete_count = 0
+    threads = []
+    for i in xrange(self.args.threads):
+      t = threading.Thread(target=self._delete_worker_factory())
+      t.daemon = True
+      threads.append(t)
+      t.start()
+    for t in threads:
+      t.join()
+    print()
+
+  def _mark_worker_factory(self):
     cloud = self.cloud.clone()
-    def delete_worker():
+    def mark_worker():
       while True:
+        with self._delete_lock:
+          path = next(self._blocks_to_mark, None)
+        if path is None:
+          return
         try:
+          ref = self.blocktree.get_ref(path, cloud)
+        except Exception as e:
+          warning('failed to read %s - %s' % (path, e))
+          self._mark_failed = True
+          return
+        if ref:
           with self._delete_lock:
-            k = self._blocks_to_delete.next()
-          cloud.delete('blocks/%s' % k)
-          with self._delete_lock:
-            self._delete_count += 1
-            if self._delete_count % (self._item_count // 110) == 0:
-              _print_deleting_progress(
-                self._item_count, self._delete_count)
-        except StopIteration:
+            self._unreferenced.discard(ref)
+    return mark_worker
+
+  def _delete_worker_factory(self):
+    cloud = self.cloud.clone()
+    def delete_worker():
+      while True:
+        with self._delete_lock:
+          batch = list(itertools.islice(self._blocks_to_delete,
+                                        self._batch_size))
+        if not batch:
           return
+        cloud.delete_many(batch)
+        with self._delete_lock:
+          for k in batch:
+            self.blocktree._alloc_discard(k)
+          self._delete_count += len(batch)
+          _print_deleting_progress(self._item_count, self._delete_count)
     return delete_worker
 
-def _print_caching_progress(item_count):
-  sys.stdout.write(
-    '\x1b[2K\x1b[1Gcaching the list of obj to cleanup ... %d'
-    % item_count
-  )
-  sys.stdout.flush()
-
 def _print_deleting_progress(total, current):
   sys.stdout.write(
     '\x1b[2K\x1b[1Gcleaning up objects ... %d%%'
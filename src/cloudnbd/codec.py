@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#
+# codec.py - Compression codecs for block payloads
+# Copyright (C) 2011  Mansour <mansour@oxplot.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import cloudnbd
+import zlib
+
+class CodecError(Exception):
+  pass
+class CodecUnavailable(CodecError):
+  pass
+
+class Codec(object):
+  """A compression algorithm. Every codec has a unique one byte id which
+  is stored along with each object, so objects compressed with
+  different codecs can coexist in the same volume.
+  """
+
+  ident = None
+  name = None
+  default_level = None
+  min_level = None
+  max_level = None
+
+  def __init__(self, level = None):
+    self.level = self.default_level if level is None else level
+
+  def compress(self, data):
+    raise NotImplementedError('abstract class')
+
+  def decompress(self, data):
+    raise NotImplementedError('abstract class')
+
+  def __str__(self):
+    if self.level is None:
+      return self.name
+    return '%s:%d' % (self.name, self.level)
+
+class NoneCodec(Codec):
+  """Store the data as is."""
+
+  ident = 0
+  name = 'none'
+
+  def compress(self, data):
+    return data
+
+  def decompress(self, data):
+    return data
+
+class ZlibCodec(Codec):
+  """zlib compression - levels 0 (stored) and 1 (fastest) to 9
+  (smallest).
+  """
+
+  ident = 1
+  name = 'zlib'
+  default_level = 6
+  min_level = 0
+  max_level = 9
+
+  def compress(self, data):
+    return zlib.compress(data, self.level)
+
+  def decompress(self, data):
+    return zlib.decompress(data)
+
+class LZ4Codec(Codec):
+  """LZ4 frame compression (requires the lz4 package)."""
+
+  ident = 2
+  name = 'lz4'
+  min_level = 0
+  max_level = 16
+
+  def __init__(self, level = None):
+    super(LZ4Codec, self).__init__(level)
+    import lz4.frame
+    self._lz4 = lz4.frame
+
+  def compress(self, data):
+    if self.level is None:
+      return self._lz4.compress(data)
+    return self._lz4.compress(data, compression_level=self.level)
+
+  def decompress(self, data):
+    return self._lz4.decompress(data)
+
+class ZstdCodec(Codec):
+  """Zstandard compression (requires the zstandard package)."""
+
+  ident = 3
+  name = 'zstd'
+  default_level = 3
+  min_level = 1
+  max_level = 22
+
+  def __init__(self, level = None):
+    super(ZstdCodec, self).__init__(level)
+    import zstandard
+    self._zstd = zstandard
+
+  def compress(self, data):
+    # compressor objects are not thread safe
+    return self._zstd.ZstdCompressor(level=self.level).compress(data)
+
+  def decompress(self, data):
+    return self._zstd.ZstdDecompressor().decompress(data)
+
+codecs = {
+  NoneCodec.name: NoneCodec,
+  ZlibCodec.name: ZlibCodec,
+  LZ4Codec.name: LZ4Codec,
+  ZstdCodec.name: ZstdCodec
+}
+
+_by_ident = dict((c.ident, c) for c in codecs.values())
+_decoders = {}
+
+def get_codec(spec):
+  """Return a codec instance for the given spec in the form of
+  <name>[:<level>] - e.g. zlib:1
+  """
+  name, _, level = spec.partition(':')
+  if name not in codecs:
+    raise CodecError("unknown codec '%s'" % name)
+  try:
+    level = int(level) if level else None
+  except ValueError:
+    raise CodecError("invalid level for codec '%s'" % name)
+  cls = codecs[name]
+  if level is not None and (cls.max_level is None
+      or not cls.min_level <= level <= cls.max_level):
+    raise CodecError("invalid level for codec '%s'" % name)
+  try:
+    return cls(level)
+  except ImportError:
+    raise CodecUnavailable("codec '%s' is not installed" % name)
+
+def decompress(ident, data):
+  """Decompress data stored with the codec given by its id."""
+  codec = _decoders.get(ident)
+  if codec is None:
+    if ident not in _by_ident:
+      raise CodecError('unknown codec id %d' % ident)
+    try:
+      codec = _by_ident[ident]()
+    except ImportError:
+      raise CodecUnavailable("codec '%s' is required but not installed"
+                             % _by_ident[ident].name)
+    _decoders[ident] = codec
+  return codec.decompress(data)
+
+def probe(data):
+  """Cheaply estimate whether compressing data is worthwhile by
+  compressing a few evenly spaced samples of it with the fastest zlib
+  level. Already compressed or encrypted data does not shrink and is
+  detected without paying for compressing all of it.
+  """
+  size = cloudnbd._compress_probe_size
+  if len(data) <= size * 2:
+    return True
+  count = cloudnbd._compress_probe_samples
+  chunk = size // count
+  step = (len(data) - chunk) // (count - 1)
+  sample = b''.join(data[i * step:i * step + chunk]
+                    for i in xrange(count))
+  return len(zlib.compress(sample, 1)) \
+    < len(sample) * cloudnbd._compress_probe_ratio
+
+def available():
+  """Return the names of codecs usable on this system."""
+  names = []
+  for name in sorted(codecs):
+    try:
+      codecs[name]()
+      names.append(name)
+    except ImportError:
+      pass
+  return names
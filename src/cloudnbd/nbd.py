@@ -37,6 +37,12 @@ class NBD(object):
   WRITE = 1
   CLOSE = 2
 
+  FLAG_HAS_FLAGS = 1
+  FLAG_READ_ONLY = 2
+
+  EPERM = 1
+  EIO = 5
+
   def __init__(self,
                host = None,
                port = None,
@@ -50,6 +56,7 @@ class NBD(object):
     self.readcb = readcb
     self.writecb = writecb
     self.closecb = closecb
+    self.read_only = False
     self._lock = threading.RLock()
     self._stats = {'reads': 0, 'writes': 0}
     self.interrupted = False
@@ -69,8 +76,11 @@ class NBD(object):
     self._lsock.bind((self.host, self.port))
     self._lsock.listen(1)
     sock, addr = self._lsock.accept()
+    flags = NBD.FLAG_HAS_FLAGS
+    if self.read_only:
+      flags |= NBD.FLAG_READ_ONLY
     sock.send(b'NBDMAGIC\x00\x00\x42\x02\x81\x86\x12\x53' +
-      struct.pack(b'>Q', self.size) + b'\0' * 128)
+      struct.pack(b'>QL', self.size, flags) + b'\0' * 124)
     while not self.interrupted:
       header = self._receive(sock, struct.calcsize(b'>LL8sQL'))
       mag, request, han, off, dlen = struct.unpack(b'>LL8sQL', header)
@@ -79,13 +89,29 @@ class NBD(object):
       if request == NBD.READ:
         with self._lock:
           self._stats['reads'] += 1
+        try:
+          data = self.readcb(off, dlen)
+        except Exception as e:
+          cloudnbd.cmd.warning('reading %d bytes at %d failed: %s'
+                               % (dlen, off, e))
+          sock.send(b'gDf\x98' + struct.pack(b'>L', NBD.EIO) + han)
+          continue
         sock.send(b'gDf\x98\0\0\0\0' + han)
-        v = self.readcb(off, dlen)
-        sock.send(self.readcb(off, dlen))
+        sock.send(data)
       elif request == NBD.WRITE:
         with self._lock:
           self._stats['writes'] += 1
-        self.writecb(off, self._receive(sock, dlen))
+        data = self._receive(sock, dlen)
+        if self.read_only:
+          sock.send(b'gDf\x98' + struct.pack(b'>L', NBD.EPERM) + han)
+          continue
+        try:
+          self.writecb(off, data)
+        except Exception as e:
+          cloudnbd.cmd.warning('writing %d bytes at %d failed: %s'
+                               % (dlen, off, e))
+          sock.send(b'gDf\x98' + struct.pack(b'>L', NBD.EIO) + han)
+          continue
         sock.send(b'gDf\x98\0\0\0\0' + han)
       elif request == NBD.CLOSE:
         sock.close()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#
+# overlay.py - Copy-on-write layers on top of a volume
+# Copyright (C) 2011  Mansour <mansour@oxplot.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import cloudnbd
+import os
+
+# A volume is made of its base blocks under blocks/ and a stack of
+# layers, each under layers/<id>/ holding the blocks changed in it along
+# with a bitmap of those blocks. The config lists the committed layers
+# oldest first and names the uncommitted one, if any, under 'cow'.
+# Committing is a single update of the config moving the uncommitted
+# layer to the list - no block is ever copied. Blocks zeroed in a layer
+# are stored as a short marker so they hide the blocks below them.
+
+# never a valid block as blocks are at least 512 bytes
+_zeroed = b'\0'
+
+def new_layer_id():
+  return os.urandom(8).encode('hex')
+
+def _layer_prefix(layer):
+  return 'layers/%s/' % layer
+
+class Layer(object):
+  """A set of blocks stored under the prefix of the layer."""
+
+  def __init__(self, blocktree, ident):
+    self.ident = ident
+    self.prefix = _layer_prefix(ident)
+    self._blocktree = blocktree
+    self.alloc = None
+
+  def open(self):
+    """Load the bitmap of the layer, rebuilding it from the list of
+    the blocks if it was not saved cleanly.
+    """
+    self.alloc = self._blocktree.load_bitmap(self.prefix + 'alloc')
+    if self.alloc is None:
+      self.alloc = cloudnbd.bitmap.Bitmap()
+      cloud = self._blocktree.cloud
+      for k in cloud.list(prefix=self.prefix + 'blocks/'):
+        self.alloc.add(int(k.name.split('/')[-1]))
+
+  def mark_unclean(self):
+    self._blocktree.save_bitmap(self.prefix + 'alloc', None)
+
+  def save(self):
+    self._blocktree.save_bitmap(self.prefix + 'alloc', self.alloc)
+
+  def path(self, block):
+    return '%sblocks/%d' % (self.prefix, block)
+
+  def drop(self, cloud):
+    """Delete all the objects of the layer."""
+    name_start = len(cloud.volume) + 1
+    for k in cloud.list(prefix=self.prefix + 'blocks/'):
+      cloud.delete(k.name[name_start:])
+    cloud.delete(self.prefix + 'alloc')
+
+class Overlay(object):
+  """Redirect the writes to blocks of a volume to an uncommitted layer,
+  and serve reads from the newest layer which has the block.
+  """
+
+  def __init__(self, blocktree, layers, top):
+    self._blocktree = blocktree
+    self._layers = [Layer(blocktree, l) for l in layers]
+    self.top = Layer(blocktree, top)
+
+  def open(self, read_only = False):
+    for layer in self._layers:
+      layer.open()
+    self.top.open()
+    if not read_only:
+      self.top.mark_unclean()
+
+  def _lower_has(self, block):
+    for layer in self._layers:
+      if block in layer.alloc:
+        return True
+    alloc = self._blocktree.alloc
+    return alloc is None or block in alloc
+
+  def block_path(self, block):
+    """Return the path of the object holding the given block."""
+    if block in self.top.alloc:
+      return self.top.path(block)
+    for layer in reversed(self._layers):
+      if block in layer.alloc:
+        return layer.path(block)
+    return 'blocks/%d' % block
+
+  def allocated(self):
+    """Return the set of blocks stored in any layer or the base."""
+    blocks = set(self._blocktree.alloc or [])
+    for layer in self._layers + [self.top]:
+      blocks.update(layer.alloc)
+    return blocks
+
+  def get_block(self, block):
+    data = self._blocktree.get(self.block_path(block))
+    return None if data == _zeroed else data
+
+  def fetch_block(self, block, cloud = None):
+    """Get a block bypassing the cache."""
+    data = self._blocktree.fetch(self.block_path(block), cloud)
+    return None if data == _zeroed else data
+
+  def set_block(self, block, data):
+    if data is None:
+      if not self._lower_has(block):
+        if block in self.top.alloc:
+          self.top.alloc.discard(block)
+          self._blocktree.set(self.top.path(block), None)
+        return
+      data = _zeroed
+    self.top.alloc.add(block)
+    self._blocktree.set(self.top.path(block), data)
+
+  def save(self):
+    """Save the bitmap of the uncommitted layer. Must only be called
+    once all writes have reached the cloud.
+    """
+    self.top.save()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+#
+# pipeline.py - Multi-process encode/decode stage
+# Copyright (C) 2011  Mansour <mansour@oxplot.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import cloudnbd
+import mmap
+import signal
+import multiprocessing
+import Queue
+
+_ENCODE = 0
+_DECODE = 1
+
+# room for the object header, padding and crypto overhead on top of the
+# block size
+_slot_overhead = 2 ** 12
+
+class PipelineError(Exception):
+  pass
+
+def _worker(blocktree, conn, buf):
+  """Serve encode/decode requests for one slot. The data travels through
+  the shared buffer and only the lengths and metadata go through the
+  pipe.
+  """
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  while True:
+    msg = conn.recv()
+    if msg is None:
+      return
+    op, path, length, metadata = msg
+    data = buf[:length]
+    outcome = None
+    try:
+      if op == _ENCODE:
+        data, metadata, outcome = blocktree._encode(path, data)
+      else:
+        data = blocktree._decode(path, data, metadata)
+    except Exception as e:
+      conn.send((e, None, None, None))
+      continue
+    if data is None:
+      conn.send((None, None, metadata, outcome))
+    elif len(data) > len(buf):
+      conn.send((None, data, metadata, outcome))
+    else:
+      buf[:len(data)] = data
+      conn.send((None, len(data), metadata, outcome))
+
+class _Slot(object):
+  """A worker process with its own shared memory buffer."""
+
+  def __init__(self, blocktree, size):
+    self.buf = mmap.mmap(-1, size)
+    self.conn, child_conn = multiprocessing.Pipe()
+    self.proc = multiprocessing.Process(
+      target=_worker,
+      args=(blocktree, child_conn, self.buf)
+    )
+    self.proc.daemon = True
+    self.proc.start()
+    child_conn.close()
+
+class CodecPool(object):
+  """Pool of processes which turn plain blocks into wire payloads and
+  back, taking compression, encryption and hashing out of the GIL.
+  """
+
+  def __init__(self, blocktree, procs, slot_size):
+    self._blocktree = blocktree
+    self._slot_size = slot_size + _slot_overhead
+    self._slots = []
+    self._free = Queue.Queue()
+    for i in xrange(procs):
+      slot = _Slot(blocktree, self._slot_size)
+      self._slots.append(slot)
+      self._free.put(slot)
+
+  def encode(self, path, data):
+    if data is None or len(data) > self._slot_size:
+      return self._blocktree._encode(path, data)
+    return self._run(_ENCODE, path, data, None)
+
+  def decode(self, path, data, metadata):
+    if data is None or len(data) > self._slot_size:
+      return self._blocktree._decode(path, data, metadata)
+    data, metadata, outcome = self._run(_DECODE, path, data, metadata)
+    return data
+
+  def _run(self, op, path, data, metadata):
+    # a slot whose worker died is put back as None, and its share of the
+    # calls is made in this process from then on - a new worker can not
+    # be forked safely once threads are running
+    slot = self._free.get()
+    try:
+      if slot is not None:
+        try:
+          return self._run_in(slot, op, path, data, metadata)
+        except PipelineError:
+          self._slots.remove(slot)
+          slot.proc.join()
+          slot.buf.close()
+          slot = None
+      if op == _ENCODE:
+        return self._blocktree._encode(path, data)
+      return self._blocktree._decode(path, data, metadata), None, None
+    finally:
+      self._free.put(slot)
+
+  def _run_in(self, slot, op, path, data, metadata):
+    try:
+      slot.buf[:len(data)] = data
+      slot.conn.send((op, path, len(data), metadata))
+      error, result, metadata, outcome = slot.conn.recv()
+    except (EOFError, IOError):
+      raise PipelineError('codec worker process died')
+    if error is not None:
+      raise error
+    if isinstance(result, int):
+      result = slot.buf[:result]
+    return result, metadata, outcome
+
+  def close(self):
+    for slot in self._slots:
+      try:
+        slot.conn.send(None)
+      except IOError:
+        pass
+    for slot in self._slots:
+      slot.proc.join()
+      slot.buf.close()
+    self._slots = []
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#
+# test_sim.py - Block tree over the simulated cloud
+# Copyright (C) 2011  Mansour <mansour@oxplot.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import cloudnbd
+
+# fast and flaky, seeded so that every run sees the same failures
+_access_key = 'latency=0.001,sigma=0,errors=0.2,seed=7'
+
+class SimBlockTreeTest(unittest.TestCase):
+
+  def setUp(self):
+    self._base_delay = cloudnbd._retry_base_delay
+    cloudnbd._retry_base_delay = 0.001
+
+  def tearDown(self):
+    cloudnbd._retry_base_delay = self._base_delay
+
+  def _run(self, bucket):
+    """Write blocks through a block tree over a fresh simulated cloud
+    and read them back, returning the request counters of the cloud.
+    """
+    cloud = cloudnbd.cloud.backends['sim'](
+      access_key=_access_key, bucket=bucket, volume='v')
+    cloud.check_access()
+    blocktree = cloudnbd.blocktree.BlockTree(
+      pass_key=b'p' * 32, crypt_key=b'c' * 32, cloud=cloud)
+    data = random.Random(1)
+    blocks = [b''.join(chr(data.randrange(256)) for i in xrange(512))
+              for n in xrange(20)]
+    for n, block in enumerate(blocks):
+      blocktree.set('blocks/%d' % n, block, direct=True)
+    for n, block in enumerate(blocks):
+      self.assertEqual(blocktree.fetch('blocks/%d' % n), block)
+    self.assertIsNone(blocktree.fetch('blocks/100'))
+    return cloud.get_stats()
+
+  def test_roundtrip_is_repeatable(self):
+    first = self._run('repeat-a')
+    second = self._run('repeat-b')
+    self.assertGreater(first['errors'], 0)
+    self.assertEqual(first, second)
+
+  def test_get_is_one_request(self):
+    cloud = cloudnbd.cloud.backends['sim'](
+      access_key='latency=0,sigma=0,seed=1', bucket='get', volume='v')
+    cloud.check_access()
+    cloud.set('x', b'content', metadata={'m': 'v'})
+    before = cloud.get_stats()['requests']
+    obj = cloud.get('x')
+    self.assertEqual(obj.get_content(), b'content')
+    self.assertEqual(obj.metadata, {'m': 'v'})
+    self.assertEqual(cloud.get_stats()['requests'] - before, 1)
+
+if __name__ == '__main__':
+  unittest.main()